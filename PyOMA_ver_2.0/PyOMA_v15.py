@@ -5,16 +5,16 @@ Created on Sun Jan 24 15:49:48 2021
 @author: dagpa
 """
 
+import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import numpy as np
 from scipy import linalg as LA
-import pandas as pd
 from scipy import signal
-from scipy.optimize import curve_fit
-import matplotlib.pyplot as plt
-from matplotlib.ticker import (MultipleLocator, FormatStrFormatter)
-import matplotlib.patches as patches
-import seaborn as sns
-import mplcursors
+try: # optional, used to limit the BLAS threads of the parallel SSI sweep
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
 
 # =============================================================================
 # FUNZIONI PRONTE
@@ -50,6 +50,52 @@ def MaC(Fi1,Fi2):
     return MAC
 
 
+#------------------------------------------------------------------------------
+
+def MaC_batch(Fi1, Fi2, dtype=None):
+    '''
+    This function returns the Modal Assurance Criterion (MAC) matrix between
+    two sets of mode shape vectors.
+    
+    The mode shapes are stored by rows: if the inputs are in the form 
+    (k,nch) and (m,nch) the output is the (k,m) MAC matrix, if the inputs 
+    are in the form (B,k,nch) and (B,m,nch) (batch of sets) the output is a
+    (B,k,m) array. The norms of the shapes are computed once and the MAC 
+    matrix is obtained through a single matrix product.
+    
+    ----------
+    Parameters
+    ----------
+    Fi1 : array (2D or 3D)
+        First set of mode shapes (by rows).
+    Fi2 : array (2D or 3D)
+        Second set of mode shapes (by rows). 
+    dtype : None or data-type
+        Precision used in the calculation, e.g. np.float32 to use single 
+        precision. None (default) uses the precision of the inputs.
+        
+    -------
+    Returns
+    -------
+    MAC : 2D (or 3D) array
+        Modal Assurance Criterion matrix.
+    '''
+    
+    Fi1 = np.asarray(Fi1)
+    Fi2 = np.asarray(Fi2)
+    if dtype is not None:
+        Fi1 = Fi1.astype(np.result_type(dtype, np.complex64), copy=False)
+        Fi2 = Fi2.astype(np.result_type(dtype, np.complex64), copy=False)
+    
+    _n1 = np.sum((Fi1.conj()*Fi1).real, axis=-1) # squared norms
+    _n2 = np.sum((Fi2.conj()*Fi2).real, axis=-1)
+    
+    MAC = np.abs(Fi1.conj() @ np.swapaxes(Fi2, -1, -2))**2 / \
+        (_n1[..., :, None]*_n2[..., None, :])
+        
+    return MAC
+
+
 #------------------------------------------------------------------------------
 
 def Exdata():
@@ -199,508 +245,1205 @@ def Exdata():
     return acc, (fn,FI_1,xi)
 
 #------------------------------------------------------------------------------
-    
-def SSIdatStaDiag(data, fs, br, ordmin=0, ordmax=None, lim=(0.01,0.05,0.02,0.1), 
-                  method='1'):
+
+def _LQ_stream(data, br, chunk):
     '''
-    This function perform the Data-driven Stochastic sub-Space Identification 
-    algorithm.
+    This function returns the lower triangular factor L of the LQ 
+    factorization of the (normalised) block Hankel matrix used by the 
+    Data-driven SSI, without building the Hankel matrix or the Q factor.
     
-    The function returns the Stabilization Diagram (Plot) for the given
-    data. Furthermore it returns a dictionary that contains the results needed
-    by the function SSImodEX().
+    The columns of the Hankel matrix are processed in blocks of (at most)
+    chunk columns, and the triangular factor is updated incrementally, so 
+    that the memory depends only on chunk and on nch*2*br (and not on the 
+    length of the record).
     
     ----------
     Parameters
     ----------
-    data : 2D array
+    data : 2D array (or array-like, e.g. np.memmap)
         The time history records (N°data points x N°channels).
-    fs : float
-        The sampling frequency.
     br : integer
         The number of block rows (time shifts).
-    ordmax : None or integer
-        The maximum model order to use in the construction of the 
-        stabilisation diagram. None (default) is equivalent to the maximum 
-        allowable model order equal to br*data.shape[1].
-    lim : tuple
-        Limit values to use for the stability requirements of the poles. The 
-        first three values are used to check the stability of the poles.
-            - Frequency: (f(n)-f(n+1))/f(n) < lim[0] (default to 0.01)
-            - Damping: (xi(n)-xi(n+1))/xi(n) < lim[1] (default to 0.05)
-            - Mode shape: 1-MAC((phi(n),phi(n+1)) < lim[2] (default to 0.02)
-        The last value (lim[3]) is used to remove all the poles that have a
-        higher damping ratio (default to 0.1).
-
-    method : "1" or "2"
-        Method to use in the estimation of the state matrix A:
-            - method "1" (default) : the first method uses the kalman state 
-                                     sequence S_(i+1) 
-            - method "2" : the second method takes advantages of the shift of
-                           the observability matrix
+    chunk : integer
+        Number of columns of the Hankel matrix processed at each step.
+        
     -------
     Returns
     -------
-    fig1 : matplotlib figure
-        Stabilisation diagram. 
-        Take advantage of the mplcursors module to identify the stable poles.
-    Results : dictionary
-        Dictionary of results.
-        This dictionary will be passed as argument to the SSImodEX() function.
+    L : 2D array
+        Lower triangular factor ((nch*2*br) x (nch*2*br)).
     '''
     
     ndat=int(data.shape[0]) # Number of data points
     nch=int(data.shape[1]) # Number of channel
-    br = int(br)
-    # If the maximum order is not given (default) it is set as the maximum
-    # allowable model order which is: number of block rows * number of channels
-    if ordmax == None:
-        ordmax = br*nch
-        
-    freq_max = fs/2 # Nyquist Frequency
+    j=ndat-2*br+1 # Dimension of the Hankel matrix
+    chunk = int(chunk)
     
-    # unpack the limits used for the construction of the Stab Diag
-    lim_f, lim_s, lim_ms, lim_s1 = lim[0], lim[1], lim[2], lim[3]
+    R = np.zeros((0, nch*2*br)) # Initialization of the triangular factor
+    for c0 in range(0, j, chunk):
+        c1 = min(c0 + chunk, j)
+        # Block of data needed to build the columns c0:c1 of the Hankel matrix
+        _blk = np.asarray(data[c0 : c1 + 2*br - 1])
+        # Block of rows of the transposed Hankel matrix
+        Hc = (1/j**0.5)*np.hstack([_blk[k:k + c1 - c0] for k in range(2*br)])
+        # Update of the triangular factor with the new block
+        R = np.linalg.qr(np.vstack((R, Hc)), mode='r')
+    
+    return R.T
 
-    Yy=data.T # 
-# =============================================================================
-    j=ndat-2*br+1; # Dimension of the Hankel matrix
+#------------------------------------------------------------------------------
 
-    H=np.zeros((nch*2*br,j)) # Initialization of the Hankel matrix
-    # for k in range(0,2*br):
-    for k in range(0,2*br):
-     	H[k*nch:((k+1)*nch),:]=(1/j**0.5)*Yy[:,k:k+j] # calculating Hankel matrix
-    
-    # LQ factorization of the Hankel matrix
-    Q , L = np.linalg.qr(H.T)
-    L = L.T
-    Q = Q.T
+def _svd_trunc(M, k, svd_method='full'):
+    '''
+    This function returns the first k singular values and singular vectors
+    of a matrix.
     
-    a = nch*br
-    b = nch
+    ----------
+    Parameters
+    ----------
+    M : 2D array
+        The matrix to decompose.
+    k : integer
+        Number of singular triplets to compute.
+    svd_method : "full", "randomized" or "arpack"
+        Algorithm used to compute the singular value decomposition:
+            - "full" (default) : dense SVD (numpy), truncated to k.
+            - "randomized" : randomized range finder (with oversampling and 
+                             power iterations) followed by the SVD of the 
+                             projected (small) matrix.
+            - "arpack" : truncated SVD through the Lanczos algorithm 
+                         implemented in ARPACK (scipy.sparse.linalg.svds).
+        If k is (close to) min(M.shape) the dense SVD is used.
+        
+    -------
+    Returns
+    -------
+    U : 2D array
+        Left singular vectors (M.shape[0] x k).
+    S : 1D array
+        Singular values (k,) in descending order.
+    V_t : 2D array
+        Right singular vectors (k x M.shape[1]).
+    '''
     
-    L21 = L[a:a+b,:a]
-    L22 = L[a:a+b,a:a+b]
-    L31 = L[a+b:,:a]
-    L32 = L[a+b:,a:a+b]
+    k = min(int(k), min(M.shape))
     
-    Q1 = Q[:a,:]
-    Q2 = Q[a:a+b,:]
+    if svd_method == 'randomized' and 2*k < min(M.shape):
+        rng = np.random.RandomState(12345) # Set the seed
+        _p = 2*k # size of the random subspace (oversampling)
+        # Range finder with power iterations (re-orthonormalised at each step)
+        Qm, _ = np.linalg.qr(M @ rng.randn(M.shape[1], _p))
+        for _q in range(4):
+            Qm, _ = np.linalg.qr(M.T @ Qm)
+            Qm, _ = np.linalg.qr(M @ Qm)
+        # SVD of the projected matrix
+        Ub, S, V_t = np.linalg.svd(Qm.T @ M, full_matrices=False)
+        U = Qm @ Ub
     
-    P_i = np.vstack((L21,L31)) @ Q1 # Projection Matrix P_i
-    P_im1 = np.hstack((L31,L32)) @ np.vstack((Q1, Q2)) # Projection P_(i-1)
-    Y_i = np.hstack((L21,L22)) @ np.vstack((Q1, Q2)) # Output sequence
+    elif svd_method == 'arpack' and k < min(M.shape) - 1:
+        from scipy.sparse.linalg import svds
+        U, S, V_t = svds(M, k=k, v0=np.ones(min(M.shape)))
+        # svds returns the singular values in ascending order
+        _idx = np.argsort(S)[::-1]
+        U, S, V_t = U[:, _idx], S[_idx], V_t[_idx, :]
     
-    # SINGULAR VALUE DECOMPOSITION
-    U1, S1, V1_t = np.linalg.svd(P_i,full_matrices=False)
-    S1 = np.diag(S1)
-    S1rad=np.sqrt(S1)
+    else:
+        U, S, V_t = np.linalg.svd(M, full_matrices=False)
     
-# =============================================================================
-    # initializing arrays
-    Fr=np.full((ordmax, int((ordmax)/2+1)), np.nan) # initialization of the matrix that contains the frequencies
-    Fr_lab=np.full((ordmax, int((ordmax)/2+1)), np.nan)  # initialization of the matrix that contains the labels of the poles
-    Sm=np.full((ordmax, int((ordmax)/2+1)), np.nan) # initialization of the matrix that contains the damping ratios
-    Ms = []  # initialization of the matrix (list of arrays) that contains the mode shapes
-    for z in range(0, int((ordmax-ordmin)/2+1)):
-        Ms.append(np.zeros((nch, ordmin + z*(2))))
-
-    # loop for increasing order of the system
-    for _ind in range(ordmin, ordmax+1, 2):
-
-        S11 = np.zeros((_ind, _ind)) # Inizializzo
-        U11 = np.zeros((br*nch, _ind)) # Inizializzo
-        V11 = np.zeros((_ind, br*nch)) # Inizializzo
-        O_1 = np.zeros((br*nch - nch, _ind)) # Inizializzo
-        O_2 = np.zeros((br*nch - nch, _ind)) # Inizializzo
-        
-        # Extraction of the submatrices for the increasing order of the system
-        S11[:_ind, :_ind] = S1rad[:_ind, :_ind] # 
-        U11[:br*nch, :_ind] = U1[:br*nch, :_ind] # 
-        V11[:_ind, :br*nch] = V1_t[:_ind, :br*nch] # 
-
-        O = U11 @ S11 # Observability matrix
-        S = np.linalg.pinv(O) @ P_i # Kalman filter state sequence
+    return U[:, :k], S[:k], V_t[:k, :]
 
-        O_1[:,:] = O[:O.shape[0] - nch,:]
-        O_2[:,:] = O[nch:,:]
-
-        # Estimate of the discrete Matrices A and C
-        if method == '2': # Method 2 
-            A = np.linalg.pinv(O_1) @ O_2 
-            C = O[:nch,:]     
-            # Ci sarebbero da calcolare le matrici G e R0 
-
-        else:  # Method 1
-            Sp1 = np.linalg.pinv(O_1) @ P_im1 # kalman state sequence S_(i+1)
-        
-            AC = np.vstack((Sp1,Y_i)) @ np.linalg.pinv(S) 
-            A = AC[:Sp1.shape[0]]
-            C = AC[Sp1.shape[0]:]
-            # Ci sarebbero da calcolare le matrici G e R0 
+#------------------------------------------------------------------------------
 
-      
-        [_AuVal, _AuVett] = np.linalg.eig(A) 
-        Lambda =(np.log(_AuVal))*fs 
-        fr = abs(Lambda)/(2*np.pi) # Natural frequencies of the system
-        smorz = -((np.real(Lambda))/(abs(Lambda))) # damping ratios
-# =============================================================================
-        # This is a fix for a bug. We make shure that there are not nans
-        # (it has, seldom, happened that at the first iteration the first
-        # eigenvalue was negative, yielding the log to return a nan that
-        # messed up with the plot of the stabilisation diagram)
-        for j in range(len(fr)):
-            if np.isnan(fr[j]) == True:
-                fr[j] = 0
-# =============================================================================
-        # Output Influence Matrix
-        C = O[:nch,:]
-        
-        # Complex mode shapes
-        Mcomp = C@_AuVett
-        # Mreal = np.real(C@_AuVett)
-        
-        # we are increasing 2 orders at each step
-        _ind_new = int((_ind-ordmin)/2) 
-    
-        Fr[:len(fr),_ind_new] = fr # save the frequencies   
-        Sm[:len(fr),_ind_new] = smorz # save the damping ratios
-        Ms[_ind_new] = Mcomp # save the mode shapes
-        
-# =============================================================================
-        # Check stability of poles
-        # 0 = Unstable pole 
-        # 1 = Stable for frequency
-        # 2 = Stable for frequency and damping
-        # 3 = Stable for frequency and mode shape
-        # 4 = Stable pole
-        
-        for idx, (_freq, _smor) in enumerate(zip(fr,smorz)):
-            if _ind_new == 0 or _ind_new == 1: # at the first iteration every pole is new
-                Fr_lab[:len(fr),_ind_new] = 0 # 
-    
-            else:
-                # Find the index of the pole that minimize the difference with iteration(order) n-1
-                ind2 = np.nanargmin(abs(_freq - Fr[:,_ind_new - 1]) 
-                                    - min(abs(_freq - Fr[:,_ind_new - 1])))
-                        
-                Fi_n = Mcomp[:, idx] # Modal shape iteration n
-                Fi_nmeno1 = Ms[int(_ind_new-1)][:,ind2] # Modal shape iteration n-1
-                
-                # aMAC = np.abs(Fi_n@Fi_nmeno1)**2 / ((Fi_n@Fi_n)*(Fi_nmeno1@Fi_nmeno1)) # autoMAC
-                aMAC =  MaC(Fi_n,Fi_nmeno1)
-                
-                cond1 = abs(_freq - Fr[ind2, _ind_new-1])/_freq
-                cond2 = abs(_smor - Sm[ind2, _ind_new-1])/_smor
-                cond3 = 1 - aMAC
-                
-                if cond1 < lim_f and cond2 < lim_s and cond3 < lim_ms:
-                    Fr_lab[idx,_ind_new] = 4 # STABLE POLE
-    
-                elif cond1 < lim_f  and cond3 < lim_ms:
-                    Fr_lab[idx,_ind_new] = 3 # Stable for freq. and m.shape
-    
-                elif cond1 < lim_f  and cond2 < lim_s:
-                    Fr_lab[idx,_ind_new] = 2 # Stable for freq. and damp.
-    
-                elif cond1 < lim_f:
-                    Fr_lab[idx,_ind_new] = 1 # Stable for freq.
-                else:
-                    Fr_lab[idx,_ind_new] = 0  # New or unstable pole
-# ============================================================================= 
-# Stabilisation Diagram
-# =============================================================================
-# Flatten everything
-    _x = Fr.flatten(order='f')
-    _y = np.array([_i//len(Fr) for _i in range(len(_x))])
-    _l = Fr_lab.flatten(order='f')
-    _d = Sm.flatten(order='f')
-    # Creating a dataframe out of the flattened results
-    df = pd.DataFrame(dict(Frequency=_x, Order=_y, Label=_l, Damp=_d))
-    
-# =============================================================================
-    # Reduced dataframe (without nans) where the modal info is saved
-    df1 = df.copy()
-    df1 = df1.dropna()
-    emme = []
-    # here I look for the index of the shape associated to a given pole
-    for effe,order in zip(df1.Frequency,df1.Order):
-        emme.append(np.nanargmin(abs(effe - Fr[:, order]))) # trovo l'indice 
-    # append the list of indexes to the dataframe
-    emme = np.array(emme)
-    df1['Emme'] = emme
-# =============================================================================
-    df2 = df1.copy()
-    # removing the poles that have damping exceding the limit value
-    df2.Frequency = df2.Frequency.where(df2.Damp < lim_s1) 
-    # removing the poles that have negative damping 
-    df2.Frequency = df2.Frequency.where(df2.Damp > 0)
+def _sweep_QR(X, Y):
+    '''
+    This function prepares the solution of the least-squares problems
+    A_n = pinv(X[:, :n]) @ Y[:, :n], for all the model orders n, with a 
+    single QR factorization of X (computed at the maximum order).
     
+    Since X[:, :n] = Q[:, :n] @ R[:n, :n], each lower order only needs the 
+    leading sub-blocks of R and of Q.T @ Y.
     
-    # Physical poles compare in pairs (complex + conjugate) 
-    # I look for the poles that DO NOT have a pair and I remove them from the dataframe
-    df3 = df2.Frequency.drop_duplicates(keep=False) 
-    df2 = df2.where(~(df2.isin(df3))) # 
-    df2 = df2.dropna()# Dropping nans
-    df2 = df2.drop_duplicates(subset='Frequency') # removing conjugates
+    ----------
+    Parameters
+    ----------
+    X : 2D array
+        Matrix at the maximum model order (e.g. the observability matrix 
+        without the last block row).
+    Y : 2D array
+        Right hand side at the maximum model order (e.g. the observability 
+        matrix without the first block row).
+        
+    -------
+    Returns
+    -------
+    sweep : tuple
+        Tuple (X, Y, R, Q.T @ Y) to be passed to _sweep_A().
+    '''
     
+    Qx, Rx = np.linalg.qr(X)
     
-    # df4 = df4.where(df2.Order > ordmin).dropna() # Tengo solo i poli sopra ordmin
-    # assigning colours to the labels
-    _colors = {0:'Red', 1:'darkorange', 2:'gold', 3:'yellow', 4:'Green'} 
+    return X, Y, Rx, Qx.T @ Y
+
+#------------------------------------------------------------------------------
+
+def _sweep_A(sweep, n):
+    '''
+    This function returns the (discrete) state matrix A_n = 
+    pinv(X[:, :n]) @ Y[:, :n] for the model order n, using the leading 
+    sub-blocks of the QR factorization computed by _sweep_QR(). If 
+    X[:, :n] is not of full column rank the pseudo-inverse is used.
     
-    fig1, ax1 = plt.subplots()
-    ax1 = sns.scatterplot(x=df2['Frequency'], y=df2['Order']*2+ordmin, hue=df2['Label'], palette=_colors)
+    ----------
+    Parameters
+    ----------
+    sweep : tuple
+        Tuple returned by _sweep_QR().
+    n : integer
+        Model order.
+        
+    -------
+    Returns
+    -------
+    A : 2D array
+        State matrix (n x n).
+    '''
     
-    ax1.set_xlim(left=0, right=freq_max)
-    ax1.set_ylim(bottom=ordmin, top=ordmax)
-    ax1.xaxis.set_major_locator(MultipleLocator(freq_max/10))
-    ax1.xaxis.set_major_formatter(FormatStrFormatter('%g'))
-    ax1.xaxis.set_minor_locator(MultipleLocator(freq_max/100))
-    ax1.set_title('''{0} - shift: {1}'''.format('Stabilization Diagram', br))
-    ax1.set_xlabel('Frequency [Hz]')
-    mplcursors.cursor()
-    # plt.show()
+    X, Y, Rx, QtY = sweep
     
-    Results={}
-    # if ordmin == None:
-    #     ordmin = 0
-    Results['Data'] = {'Data': data}
-    Results['Data']['Samp. Freq.'] = fs
-    Results['Data']['Ord min, max'] = (0, ordmax)
-    Results['Data']['Block rows'] = br
+    _d = abs(np.diag(Rx))
+    if 0 < n <= len(_d) and _d[:n].min() > _d.max()*max(X.shape)*np.finfo(float).eps:
+        A = LA.solve_triangular(Rx[:n, :n], QtY[:n, :n])
+    else:
+        A = np.linalg.pinv(X[:, :n]) @ Y[:, :n]
     
-    Results['All Poles'] = df1
-    Results['Reduced Poles'] = df2
-    Results['Modes'] = Ms
-   
-    return fig1, Results
-
+    return A
 
 #------------------------------------------------------------------------------
 
-
-def SSIcovStaDiag(data, fs, br, ordmin=0, ordmax=None, lim=(0.01,0.05,0.02,0.1), 
-                  method='1'):
+def _stab_lab(fr, smorz, Mcomp, fr_prev, sm_prev, Ms_prev, lim):
     '''
-    This function perform the covariance-driven Stochastic sub-Space 
-    Identification algorithm.
+    This function classifies (at once) all the poles of a given model order 
+    comparing them with the poles of the previous order.
     
-    The function returns the Stabilization Diagram (Plot) for the given
-    data. Furthermore it returns a dictionary that contains the results needed
-    by the function SSImodEX().
+    Each pole is compared with the pole of the previous order that has the 
+    closest frequency, and labelled as:
+        0 = Unstable pole 
+        1 = Stable for frequency
+        2 = Stable for frequency and damping
+        3 = Stable for frequency and mode shape
+        4 = Stable pole
     
     ----------
     Parameters
     ----------
-    data : 2D array
-        The time history records (N°data points x N°channels).
-    fs : float
-        The sampling frequency.
-    br : integer
-        The number of block rows (time shifts).
-    ordmax : None or integer
-        The maximum model order to use in the construction of the 
-        stabilisation diagram. None (default) is equivalent to the maximum 
-        allowable model order equal to br*data.shape[1].
+    fr : 1D array
+        Frequencies of the poles of order n.
+    smorz : 1D array
+        Damping ratios of the poles of order n.
+    Mcomp : 2D array
+        Mode shapes of the poles of order n (N°channels x N°poles).
+    fr_prev : 1D array
+        Frequencies of the poles of order n-1 (can be padded with nans).
+    sm_prev : 1D array
+        Damping ratios of the poles of order n-1 (can be padded with nans).
+    Ms_prev : 2D array
+        Mode shapes of the poles of order n-1.
     lim : tuple
-        Limit values to use for the stability requirements of the poles. The 
-        first three values are used to check the stability of the poles.
-            - Frequency: (f(n)-f(n+1))/f(n) < lim[0] (default to 0.01)
-            - Damping: (xi(n)-xi(n+1))/xi(n) < lim[1] (default to 0.05)
-            - Mode shape: 1-MAC((phi(n),phi(n+1)) < lim[2] (default to 0.02)
-        The last value (lim[3]) is used to remove all the poles that have a
-        higher damping ratio (default to 0.1, N.B. in structural dynamics
-        we usually deal with underdamped system)
-
-    method : "1" or "2"
-        Method to use in the estimation of the state matrix A:
-            - method "1" (default) : the first method takes advantages of the 
-                                     shift structrure of the observability
-                                     matrix.
-            - method "2" : the second method is based on the decomposition 
-                           property of the one-lag shifted Toeplitz matrix.
+        Limit values for frequency, damping and mode shape (see 
+        SSIcovStaDiag()).
+        
     -------
     Returns
     -------
-    fig1 : matplotlib figure
-        Stabilisation diagram. 
-        Take advantage of the mplcursors module to identify the stable poles.
-    Results : dictionary
-        Dictionary of results.
-        This dictionary will be passed as argument to the SSImodEX() function.
+    labels : 1D array
+        Labels of the poles of order n.
     '''
     
-    ndat=int(data.shape[0]) # Number of data points
-    nch=int(data.shape[1]) # Number of channel
-    br = int(br)
-    # If the maximum order is not given (default) it is set as the maximum
-    # allowable model order which is: number of block rows * number of channels
-    if ordmax == None:
-        ordmax = br*nch
-        
-    freq_max = fs/2 # Nyquist Frequency
+    lim_f, lim_s, lim_ms = lim[0], lim[1], lim[2]
     
-    # unpack the limits used for the construction of the Stab Diag
-    lim_f, lim_s, lim_ms, lim_s1 = lim[0], lim[1], lim[2], lim[3]
-
-    Yy=data.T # 
-        
-# =============================================================================
-    # Calculating R[i] (with i from 0 to 2*br)
-    R_is = np.array([1/(ndat - _s)*(Yy[:, : ndat - _s]@Yy[:, _s:].T) for _s in range(br*2+1)]) 
+    # Distance matrix between the frequencies of order n and order n-1
+    _dist = abs(fr[:, None] - fr_prev[None, :])
+    # Index of the pole that minimize the difference with order n-1
+    ind2 = np.nanargmin(_dist - np.nanmin(_dist, axis=1, keepdims=True), axis=1)
+    
+    Fi_n = Mcomp # Modal shapes order n
+    Fi_nmeno1 = Ms_prev[:, ind2] # Modal shapes order n-1 (closest poles)
     
-    # Assembling the Toepliz matrix
-    Tb = np.vstack([np.hstack([R_is[_o,:,:] for _o in range(br+_l, _l, -1)]) for _l in range(br)])
+    # autoMAC between each pole and the closest pole of order n-1
+    aMAC = MaC_batch(Fi_n.T[:, None, :], Fi_nmeno1.T[:, None, :])[:, 0, 0]
     
-    # One-lag shifted Toeplitz matrix (used in "NExT-ERA" method)
-    Tb2 = np.vstack([np.hstack([R_is[_o,:,:] for _o in range(br+_l, _l,-1)]) for _l in range(1,br+1)])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cond1 = abs(fr - fr_prev[ind2])/fr < lim_f
+        cond2 = abs(smorz - sm_prev[ind2])/smorz < lim_s
+        cond3 = 1 - aMAC < lim_ms
     
+    labels = np.select([cond1 & cond2 & cond3, # Stable pole
+                        cond1 & cond3, # Stable for freq. and m.shape
+                        cond1 & cond2, # Stable for freq. and damp.
+                        cond1], # Stable for freq.
+                       [4, 3, 2, 1], default=0) # New or unstable pole
+    
+    return labels
 
-    # SINGULAR VALUE DECOMPOSITION
-    U1, S1, V1_t = np.linalg.svd(Tb)
-    S1 = np.diag(S1)
-    S1rad=np.sqrt(S1)
+#------------------------------------------------------------------------------
+
+def _sweep_poles(sweep, C, fs, orders):
+    '''
+    This function returns the poles (frequencies and damping ratios) and the
+    mode shapes for the given model orders.
     
-# =============================================================================
-    # initializing arrays
-    Fr=np.full((ordmax, int((ordmax)/2+1)), np.nan) # initialization of the matrix that contains the frequencies
-    Fr_lab=np.full((ordmax, int((ordmax)/2+1)), np.nan)  # initialization of the matrix that contains the labels of the poles
-    Sm=np.full((ordmax, int((ordmax)/2+1)), np.nan) # initialization of the matrix that contains the damping ratios
-    Ms = []  # initialization of the matrix (list of arrays) that contains the mode shapes
-    for z in range(0, int((ordmax-ordmin)/2+1)):
-        Ms.append(np.zeros((nch, z*(2))))
-
-    # loop for increasing order of the system
-    for _ind in range(ordmin, ordmax+1, 2):
-
-        S11 = np.zeros((_ind, _ind)) # Inizializzo
-        U11 = np.zeros((br*nch, _ind)) # Inizializzo
-        V11 = np.zeros((_ind, br*nch)) # Inizializzo
-        O_1 = np.zeros((br*nch - nch, _ind)) # Inizializzo
-        O_2 = np.zeros((br*nch - nch, _ind)) # Inizializzo
-
-        # Extraction of the submatrices for the increasing order of the system
-        S11[:_ind, :_ind] = S1rad[:_ind, :_ind] # 
-        U11[:br*nch, :_ind] = U1[:br*nch, :_ind] # 
-        V11[:_ind, :br*nch] = V1_t[:_ind, :br*nch] # 
-
-        O = U11 @ S11 # Observability matrix
-        # _GAM = S11 @ V11 # Controllability matrix
+    Of each pair of complex conjugate poles only the one with positive 
+    imaginary part is returned (the other one has the same frequency and 
+    damping, and conjugate mode shape).
+    
+    ----------
+    Parameters
+    ----------
+    sweep : tuple
+        Tuple returned by _sweep_QR().
+    C : 2D array
+        Output influence matrix at the maximum order (first block row of the
+        observability matrix).
+    fs : float
+        The sampling frequency.
+    orders : list
+        Model orders.
         
-        O_1[:,:] = O[:O.shape[0] - nch,:]
-        O_2[:,:] = O[nch:,:]
-
-        # Estimating matrix A
-        if method == '2':
-            A = np.linalg.inv(S11)@U11.T@Tb2@V11.T@np.linalg.inv(S11) # Method 2 "NExT-ERA"
-        else:
-            A = np.linalg.pinv(O_1)@O_2 # Method 1 (BALANCED_REALIZATION)
+    -------
+    Returns
+    -------
+    poles : list
+        List of tuples (fr, smorz, Mcomp, conj), one for each order, 
+        containing the natural frequencies, the damping ratios, the complex
+        mode shapes and the conjugate flags (1 for complex poles, 0 for 
+        real poles).
+    '''
+    
+    poles = []
+    for _ind in orders:
+        # Estimate of the discrete Matrix A
+        A = _sweep_A(sweep, _ind)
         
         [_AuVal, _AuVett] = np.linalg.eig(A)
+        # The complex poles come in conjugate pairs (A is real): only the 
+        # member with positive imaginary part (and the real poles) are kept
+        _keep = np.imag(_AuVal) >= 0
+        _AuVal, _AuVett = _AuVal[_keep], _AuVett[:, _keep]
+        
         Lambda =(np.log(_AuVal))*fs 
-        fr = abs(Lambda)/(2*np.pi) # natural frequencies
+        fr = abs(Lambda)/(2*np.pi) # Natural frequencies of the system
         smorz = -((np.real(Lambda))/(abs(Lambda))) # damping ratios
 # =============================================================================
         # This is a fix for a bug. We make shure that there are not nans
         # (it has, seldom, happened that at the first iteration the first
         # eigenvalue was negative, yielding the log to return a nan that
         # messed up with the plot of the stabilisation diagram)
-        for _j in range(len(fr)):
-            if np.isnan(fr[_j]) == True:
-                fr[_j] = 0
+        fr[np.isnan(fr)] = 0
 # =============================================================================
-        # Output Influence Matrix
-        C = O[:nch,:]
-        
         # Complex mode shapes
-        Mcomp = C@_AuVett
+        Mcomp = C[:,:_ind]@_AuVett
         # Mreal = np.real(C@_AuVett)
         
-        # we are increasing 2 orders at each step
-        _ind_new = int((_ind-ordmin)/2) 
-    
-        Fr[:len(fr),_ind_new] = fr # save the frequencies   
-        Sm[:len(fr),_ind_new] = smorz # save the damping ratios
-        Ms[_ind_new] = Mcomp # save the mode shapes
-        
-# =============================================================================
-        # Check stability of poles
-        # 0 = Unstable pole labe
-        # 1 = Stable for frequency
-        # 2 = Stable for frequency and damping
-        # 3 = Stable for frequency and mode shape
-        # 4 = Stable pole
+        # Conjugate flag (1 complex pole, 0 real pole)
+        conj = np.sign(np.imag(_AuVal)).astype(np.int8)
         
-        for idx, (_freq, _smor) in enumerate(zip(fr,smorz)):
-            if _ind_new == 0 or _ind_new == 1: # at the first iteration every pole is new
-                Fr_lab[:len(fr),_ind_new] = 0 # 
+        poles.append((fr, smorz, Mcomp, conj))
     
-            else:
-                # Find the index of the pole that minimize the difference with iteration(order) n-1
-                ind2 = np.nanargmin(abs(_freq - Fr[:,_ind_new - 1]) 
-                                    - min(abs(_freq - Fr[:,_ind_new - 1])))
-                        
-                Fi_n = Mcomp[:, idx] # Modal shape iteration n
-                Fi_nmeno1 = Ms[int(_ind_new-1)][:,ind2] # Modal shape iteration n-1
-                
-                # aMAC = np.abs(Fi_n@Fi_nmeno1)**2 / ((Fi_n@Fi_n)*(Fi_nmeno1@Fi_nmeno1)) # autoMAC
-                aMAC =  MaC(Fi_n,Fi_nmeno1)
-                
-                cond1 = abs(_freq - Fr[ind2, _ind_new-1])/_freq
-                cond2 = abs(_smor - Sm[ind2, _ind_new-1])/_smor
-                cond3 = 1 - aMAC
-                
-                if cond1 < lim_f and cond2 < lim_s and cond3 < lim_ms:
-                    Fr_lab[idx,_ind_new] = 4 # 
-    
-                elif cond1 < lim_f  and cond3 < lim_ms:
-                    Fr_lab[idx,_ind_new] = 3 # 
-    
-                elif cond1 < lim_f  and cond2 < lim_s:
-                    Fr_lab[idx,_ind_new] = 2 # 
-    
-                elif cond1 < lim_f:
-                    Fr_lab[idx,_ind_new] = 1 #
-                else:
-                    Fr_lab[idx,_ind_new] = 0  # Nuovo polo o polo instabile
+    return poles
+
+#------------------------------------------------------------------------------
+
+def _sweep_poles_1thread(sweep, C, fs, orders):
+    '''
+    Same as _sweep_poles(), with the BLAS threads limited to one (worker 
+    processes of _sweep_run()).
+    '''
+    
+    if threadpool_limits is None:
+        return _sweep_poles(sweep, C, fs, orders)
+    with threadpool_limits(limits=1):
+        return _sweep_poles(sweep, C, fs, orders)
+
+#------------------------------------------------------------------------------
+
+def _sweep_run(sweep, C, fs, orders, n_jobs=1, backend='thread'):
+    '''
+    This function computes the poles and the mode shapes for all the model
+    orders, distributing the orders over a pool of workers.
+    
+    ----------
+    Parameters
+    ----------
+    sweep, C, fs, orders :
+        See _sweep_poles().
+    n_jobs : integer
+        Number of workers. Default to 1 (sequential), -1 uses all the CPUs.
+    backend : "thread" or "process"
+        Pool of workers. Default to "thread".
+        
+    -------
+    Returns
+    -------
+    poles : list
+        List of tuples (fr, smorz, Mcomp, conj), in the same order as 
+        orders.
+    '''
+    
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = min(int(n_jobs), len(orders))
+    if n_jobs <= 1:
+        return _sweep_poles(sweep, C, fs, orders)
+    
+    # Each worker gets every n_jobs-th order (to balance the load)
+    _chunks = [orders[_w::n_jobs] for _w in range(n_jobs)]
+    _args = ([sweep]*n_jobs, [C]*n_jobs, [fs]*n_jobs, _chunks)
+    
+    if backend == 'process':
+        with ProcessPoolExecutor(max_workers=n_jobs) as _ex:
+            _res = list(_ex.map(_sweep_poles_1thread, *_args))
+    else:
+        # The BLAS thread pool is shared by the threads: limit it to one
+        # thread to avoid oversubscription
+        with ThreadPoolExecutor(max_workers=n_jobs) as _ex:
+            if threadpool_limits is None:
+                _res = list(_ex.map(_sweep_poles, *_args))
+            else:
+                with threadpool_limits(limits=1):
+                    _res = list(_ex.map(_sweep_poles, *_args))
+    
+    poles = [None]*len(orders)
+    for _w, _r in enumerate(_res):
+        poles[_w::n_jobs] = _r
+    
+    return poles
+
+#------------------------------------------------------------------------------
+
+def _pole_table(Fr, Sm, Fr_lab, Conj, lim_s1):
+    '''
+    This function organises the poles of the stabilisation diagram in a 
+    table (NumPy structured array), with one row for each pole and the
+    fields:
+        - 'Order' : index of the model order (step of the order sweep)
+        - 'Emme' : index of the mode shape in Results['Modes'][Order]
+        - 'Frequency' : natural frequency
+        - 'Damp' : damping ratio
+        - 'Label' : stability label (0 to 4)
+        - 'Conj' : conjugate flag (1 complex pole, i.e. the member with 
+                   positive imaginary part of a conjugate pair, 0 real pole)
+    
+    ----------
+    Parameters
+    ----------
+    Fr, Sm, Fr_lab, Conj : list
+        Lists (one array for each order) of the frequencies, damping ratios,
+        labels and conjugate flags of the poles.
+    lim_s1 : float
+        Poles with damping ratio higher than lim_s1 are removed from the 
+        reduced table.
+        
+    -------
+    Returns
+    -------
+    tab : structured array
+        Table of all the poles (without nans).
+    tab_red : structured array
+        Reduced table: complex poles with damping ratio between 0 and 
+        lim_s1.
+    '''
+    
+    _npoles = [len(_f) for _f in Fr]
+    tab = np.zeros(sum(_npoles), dtype=[('Order', np.int32), ('Emme', np.int32),
+                                        ('Frequency', float), ('Damp', float), 
+                                        ('Label', np.int8), ('Conj', np.int8)])
+    
+    tab['Order'] = np.repeat(np.arange(len(Fr)), _npoles)
+    # index of the (first) shape associated to a given frequency 
+    tab['Emme'] = np.concatenate([np.zeros(0, dtype=int)] + 
+                                 [_first[_inv] for _first, _inv in 
+                                  (np.unique(_f, return_index=True, return_inverse=True)[1:] 
+                                   for _f in Fr)])
+    tab['Frequency'] = np.concatenate([np.zeros(0)] + Fr)
+    tab['Damp'] = np.concatenate([np.zeros(0)] + Sm)
+    tab['Label'] = np.concatenate([np.zeros(0)] + Fr_lab)
+    tab['Conj'] = np.concatenate([np.zeros(0)] + Conj)
+    
+    # removing the nans
+    tab = tab[~np.isnan(tab['Frequency']) & ~np.isnan(tab['Damp'])]
+    
+    # removing the poles that have damping exceding the limit value or 
+    # negative damping, and the poles that do not have a pair (physical 
+    # poles compare in pairs)
+    tab_red = tab[(tab['Damp'] < lim_s1) & (tab['Damp'] > 0) & (tab['Conj'] == 1)]
+    
+    return tab, tab_red
+
+#------------------------------------------------------------------------------
+
+def _SSI_poles(sweep, C, fs, ordmin, ordmax, lim, n_jobs=1, backend='thread'):
+    '''
+    This function computes the poles and the mode shapes for all the model
+    orders (see _sweep_run()), labels the poles according to their 
+    stability (see _stab_lab()) and builds the tables of the poles (see 
+    _pole_table()). It is the common final part of the SSI functions.
+    
+    ----------
+    Parameters
+    ----------
+    sweep, C, fs :
+        See _sweep_poles().
+    ordmin, ordmax : integer
+        Minimum and maximum model order.
+    lim : tuple
+        Limit values for the stability requirements (see SSIcov()).
+    n_jobs, backend :
+        See _sweep_run().
+        
+    -------
+    Returns
+    -------
+    df1, df2 : structured arrays
+        Table of all the poles and reduced table (see _pole_table()).
+    Ms : list
+        Mode shapes, one array for each order.
+    '''
+    
+    lim_s1 = lim[3]
+    
+    _orders = list(range(ordmin, ordmax+1, 2))
+    _poles = _sweep_run(sweep, C, fs, _orders, n_jobs, backend)
+
+    Fr = [] # frequencies (one array for each order)
+    Sm = [] # damping ratios
+    Fr_lab = [] # labels of the poles
+    Conj = [] # conjugate flags
+    Ms = [] # mode shapes
+    # loop for increasing order of the system (labelling of the poles)
+    # (we are increasing 2 orders at each step)
+    for _ind_new, (fr, smorz, Mcomp, conj) in enumerate(_poles):
+# =============================================================================
+        # Check stability of poles
+        # 0 = Unstable pole 
+        # 1 = Stable for frequency
+        # 2 = Stable for frequency and damping
+        # 3 = Stable for frequency and mode shape
+        # 4 = Stable pole
+        
+        if _ind_new == 0 or _ind_new == 1: # at the first iteration every pole is new
+            lab = np.zeros(len(fr)) # 
+        else:
+            lab = _stab_lab(fr, smorz, Mcomp, Fr[-1], Sm[-1], Ms[-1], lim)
+        
+        Fr.append(fr) # save the frequencies   
+        Sm.append(smorz) # save the damping ratios
+        Fr_lab.append(lab) # save the labels
+        Conj.append(conj) # save the conjugate flags
+        Ms.append(Mcomp) # save the mode shapes
 # ============================================================================= 
-# Stabilisation Diagram
+    # Table of the poles and reduced table (physical poles)
+    df1, df2 = _pole_table(Fr, Sm, Fr_lab, Conj, lim_s1)
+    
+    return df1, df2, Ms
+
+#------------------------------------------------------------------------------
+    
+def SSIdat(data, fs, br, ordmin=0, ordmax=None, lim=(0.01,0.05,0.02,0.1), 
+                  method='1', chunk=None, svd_method='full', n_jobs=1, 
+                  backend='thread'):
+    '''
+    This function perform the Data-driven Stochastic sub-Space Identification 
+    algorithm.
+    
+    The function returns a dictionary that contains the results needed
+    by the functions SSImodEX() and SSIStaDiagPlot(). No plot is produced 
+    (matplotlib is not needed), see SSIdatStaDiag() for the Stabilization 
+    Diagram.
+    
+    ----------
+    Parameters
+    ----------
+    data : 2D array
+        The time history records (N°data points x N°channels).
+    fs : float
+        The sampling frequency.
+    br : integer
+        The number of block rows (time shifts).
+    ordmax : None or integer
+        The maximum model order to use in the construction of the 
+        stabilisation diagram. None (default) is equivalent to the maximum 
+        allowable model order equal to br*data.shape[1].
+    lim : tuple
+        Limit values to use for the stability requirements of the poles. The 
+        first three values are used to check the stability of the poles.
+            - Frequency: (f(n)-f(n+1))/f(n) < lim[0] (default to 0.01)
+            - Damping: (xi(n)-xi(n+1))/xi(n) < lim[1] (default to 0.05)
+            - Mode shape: 1-MAC((phi(n),phi(n+1)) < lim[2] (default to 0.02)
+        The last value (lim[3]) is used to remove all the poles that have a
+        higher damping ratio (default to 0.1).
+
+    method : "1" or "2"
+        Method to use in the estimation of the state matrix A:
+            - method "1" (default) : the first method uses the kalman state 
+                                     sequence S_(i+1) 
+            - method "2" : the second method takes advantages of the shift of
+                           the observability matrix
+    chunk : None or integer
+        Number of columns of the Hankel matrix processed at a time by the
+        (streaming) LQ factorization. None (default) is equivalent to five 
+        times the number of rows of the Hankel matrix (5*2*br*nch).
+        Neither the Hankel matrix nor the Q factor are ever formed, and the 
+        algorithm works entirely on the triangular factor L, so that the 
+        memory does not depend on the length of the record (data can also 
+        be a np.memmap).
+    svd_method : "full", "randomized" or "arpack"
+        Algorithm used for the singular value decomposition. Only the first
+        ordmax singular values and vectors are computed:
+            - "full" (default) : dense SVD.
+            - "randomized" : randomized SVD (range finder plus power 
+                             iterations).
+            - "arpack" : truncated SVD through the Lanczos algorithm 
+                         (ARPACK).
+        The truncated methods are much faster when ordmax is small compared
+        to br*N°channels.
+    n_jobs : integer
+        Number of workers used to compute the state matrices, the poles 
+        and the mode shapes of the different model orders. Default to 1 
+        (sequential), -1 uses all the available CPUs. The BLAS threads of 
+        the workers are limited to one (if threadpoolctl is installed).
+    backend : "thread" or "process"
+        Pool of workers used when n_jobs is not 1. Default to "thread".
+    -------
+    Returns
+    -------
+    Results : dictionary
+        Dictionary of results (poles and mode shapes).
+        This dictionary will be passed as argument to the SSImodEX() and 
+        SSIStaDiagPlot() functions.
+    '''
+    
+    nch=int(data.shape[1]) # Number of channel
+    br = int(br)
+    # If the maximum order is not given (default) it is set as the maximum
+    # allowable model order which is: number of block rows * number of channels
+    if ordmax == None:
+        ordmax = br*nch
+    
+# =============================================================================
+    a = nch*br
+    b = nch
+    
+    # If the block size is not given (default) it is set to five times the 
+    # number of rows of the Hankel matrix
+    if chunk is None:
+        chunk = 5*nch*2*br
+    
+    # LQ factorization of the Hankel matrix (H and Q are never formed)
+    L = _LQ_stream(data, br, chunk)
+    
+    L21 = L[a:a+b,:a]
+    L31 = L[a+b:,:a]
+    L32 = L[a+b:,a:a+b]
+    
+    # The projections are expressed in the basis of the rows of [Q1; Q2]
+    # (i.e. P_i = P_i_L @ [Q1; Q2]). Since the rows of Q are orthonormal, 
+    # the singular values and left singular vectors of P_i, as well as the 
+    # products with pinv(S), are the same as those of the full matrices.
+    P_i = np.hstack((np.vstack((L21,L31)), np.zeros((a, b)))) # Projection Matrix P_i
+    P_im1 = np.hstack((L31,L32)) # Projection P_(i-1)
+    
+    # SINGULAR VALUE DECOMPOSITION
+    U1, S1, V1_t = _svd_trunc(P_i, ordmax, svd_method)
+    S1rad=np.sqrt(S1)
+    
+    O = U1 * S1rad # Observability matrix (at the maximum order)
+    
+    # One QR factorization of the shifted observability matrix, the lower 
+    # orders are obtained from the leading sub-blocks
+    if method == '2': # Method 2 (shift of the observability matrix)
+        sweep = _sweep_QR(O[:O.shape[0] - nch,:], O[nch:,:])
+    else: # Method 1 (kalman state sequences S_i and S_(i+1))
+        # A = pinv(O_1) @ P_(i-1) @ pinv(S_i), with pinv(S_i) = V1 @ S1^-1/2
+        sweep = _sweep_QR(O[:O.shape[0] - nch,:], (P_im1 @ V1_t.T) / S1rad)
+    
+# =============================================================================
+    # Poles and mode shapes for all the orders (possibly in parallel), 
+    # labels and tables of the poles
+    df1, df2, Ms = _SSI_poles(sweep, O[:nch,:], fs, ordmin, ordmax, lim, 
+                              n_jobs, backend)
+    
+    Results={}
+    # if ordmin == None:
+    #     ordmin = 0
+    Results['Data'] = {'Data': data}
+    Results['Data']['Samp. Freq.'] = fs
+    Results['Data']['Ord min max'] = (ordmin, ordmax)
+    Results['Data']['Block rows'] = br
+    
+    Results['All Poles'] = df1
+    Results['Reduced Poles'] = df2
+    Results['Modes'] = Ms
+   
+    return Results
+
+
+#------------------------------------------------------------------------------
+
+def SSIdatStaDiag(data, fs, br, ordmin=0, ordmax=None, lim=(0.01,0.05,0.02,0.1), 
+                  method='1', **kwargs):
+    '''
+    This function perform the Data-driven Stochastic sub-Space 
+    Identification algorithm (see SSIdat()).
+    
+    The function returns the Stabilization Diagram (Plot) for the given
+    data. Furthermore it returns a dictionary that contains the results needed
+    by the function SSImodEX().
+    
+    ----------
+    Parameters
+    ----------
+    data, fs, br, ordmin, ordmax, lim, method :
+        See SSIdat().
+    **kwargs : 
+        Other optional arguments passed to SSIdat().
+    -------
+    Returns
+    -------
+    fig1 : matplotlib figure
+        Stabilisation diagram. 
+        Take advantage of the mplcursors module to identify the stable poles.
+    Results : dictionary
+        Dictionary of results.
+        This dictionary will be passed as argument to the SSImodEX() function.
+    '''
+    
+    Results = SSIdat(data, fs, br, ordmin=ordmin, ordmax=ordmax, lim=lim, 
+                     method=method, **kwargs)
+    fig1 = SSIStaDiagPlot(Results)
+   
+    return fig1, Results
+
+
+#------------------------------------------------------------------------------
+
+def _corr_fft(data, nlag, chunk=None, ref=None):
+    '''
+    This function returns the (unbiased) correlation matrices of the signals
+    for the time lags 0, 1, ..., nlag-1, computed via the FFT 
+    (Wiener-Khinchin theorem).
+    
+    The record is processed in blocks of chunk data points: for each block 
+    the real FFTs of the block and of the block extended by nlag-1 points 
+    are computed (zero padded, so that the circular correlation is equal to 
+    the linear one), and the cross-spectra are accumulated. A single inverse
+    FFT is performed at the end.
+    
+    ----------
+    Parameters
+    ----------
+    data : 2D array (or array-like, e.g. np.memmap)
+        The time history records (N°data points x N°channels).
+    nlag : integer
+        Number of time lags.
+    chunk : None or integer
+        Number of data points processed at each step. None (default) sets
+        the length of the FFT to the first power of two greater than 8*nlag.
+    ref : None or list
+        Indices of the reference channels. If given, all the channels are 
+        correlated only with the reference channels. Default to None.
+        
+    -------
+    Returns
+    -------
+    R_is : 3D array
+        Correlation matrices (nlag x N°channels x N°channels), 
+        R_is[s] = 1/(ndat-s) * Y[:, :ndat-s] @ Y[:, s:].T
+        or, if ref is given, (nlag x N°channels x N°references),
+        R_is[s] = 1/(ndat-s) * Y[:, s:] @ Y[ref, :ndat-s].T
+    '''
+    
+    ndat=int(data.shape[0]) # Number of data points
+    nch=int(data.shape[1]) # Number of channel
+    maxlag = int(nlag) - 1
+    
+    if chunk is None:
+        nfft = 2**int(np.ceil(np.log2(8*(maxlag+1))))
+        chunk = nfft - maxlag
+    else:
+        chunk = int(chunk)
+        nfft = 2**int(np.ceil(np.log2(chunk + maxlag)))
+    
+    nref = nch if ref is None else len(ref)
+    
+    Sxy = np.zeros((nch, nref, nfft//2+1), dtype=complex) # cross-spectra
+    for t0 in range(0, ndat, chunk):
+        t1 = min(t0 + chunk, ndat)
+        X = np.fft.rfft(np.asarray(data[t0:t1]).T, n=nfft, axis=1)
+        Z = np.fft.rfft(np.asarray(data[t0:min(t1 + maxlag, ndat)]).T, n=nfft, axis=1)
+        if ref is None:
+            Sxy += X.conj()[:, None, :] * Z[None, :, :]
+        else:
+            Sxy += Z[:, None, :] * X[ref].conj()[None, :, :]
+    
+    # Correlation functions (only the positive lags are needed)
+    corr = np.fft.irfft(Sxy, n=nfft, axis=2)[:, :, :maxlag+1]
+    R_is = corr.transpose(2, 0, 1) / (ndat - np.arange(maxlag+1))[:, None, None]
+    
+    return R_is
+
+#------------------------------------------------------------------------------
+
+def _block_toeplitz(R_is, br):
+    '''
+    This function assembles the block Toeplitz matrix and the one-lag 
+    shifted block Toeplitz matrix from the correlation matrices.
+    
+    Both matrices are written directly into a single preallocated buffer 
+    with (br+1) block rows: the Toeplitz matrix is given by the first br 
+    block rows and the shifted one by the last br block rows, so that the 
+    two matrices share the same storage.
+    
+    ----------
+    Parameters
+    ----------
+    R_is : 3D array
+        Correlation matrices (2*br+1 x N°rows x N°columns of each block).
+    br : integer
+        The number of block rows (time shifts).
+        
+    -------
+    Returns
+    -------
+    Tb : 2D array
+        Block Toeplitz matrix, with blocks Tb[l, c] = R_is[br+l-c].
+    Tb2 : 2D array
+        One-lag shifted block Toeplitz matrix, Tb2[l, c] = R_is[br+l+1-c].
+    '''
+    
+    nr, nc = R_is.shape[1], R_is.shape[2]
+    
+    # Strided view of the correlations: _W[l, :, :, c] = R_is[br+l-c]
+    _W = np.lib.stride_tricks.sliding_window_view(R_is[1:], br, axis=0)[..., ::-1]
+    
+    T = np.empty(((br+1)*nr, br*nc))
+    T.reshape(br+1, nr, br, nc)[...] = _W.transpose(0, 1, 3, 2)
+    
+    Tb = T[:br*nr] # Toeplitz matrix
+    Tb2 = T[nr:] # One-lag shifted Toeplitz matrix
+    
+    return Tb, Tb2
+
+#------------------------------------------------------------------------------
+
+def _corr(data, nlag, ref=None, corr_method='direct'):
+    '''
+    This function returns the correlation matrices of the signals for the 
+    time lags 0, 1, ..., nlag-1 (see _corr_fft()).
+    
+    ----------
+    Parameters
+    ----------
+    data : 2D array
+        The time history records (N°data points x N°channels).
+    nlag : integer
+        Number of time lags.
+    ref : None or list
+        Indices of the reference channels (see _corr_fft()). Default to None.
+    corr_method : "direct" or "fft"
+        See SSIcov().
+        
+    -------
+    Returns
+    -------
+    R_is : 3D array
+        Correlation matrices (see _corr_fft()).
+    '''
+    
+    if corr_method == 'fft':
+        return _corr_fft(data, nlag, ref=ref)
+    
+    ndat=int(data.shape[0]) # Number of data points
+    Yy=data.T # 
+    if ref is None:
+        R_is = np.array([1/(ndat - _s)*(Yy[:, : ndat - _s]@Yy[:, _s:].T) for _s in range(nlag)]) 
+    else:
+        R_is = np.array([1/(ndat - _s)*(Yy[:, _s:]@Yy[ref, : ndat - _s].T) for _s in range(nlag)]) 
+    
+    return R_is
+
+#------------------------------------------------------------------------------
+
+def _SSIcov_sweep(R_is, br, ordmax, method='1', svd_method='full'):
+    '''
+    This function assembles the block Toeplitz matrices from the correlation
+    matrices, computes the observability matrix and returns the QR 
+    factorization used to obtain the state matrices of all the model orders
+    (see _sweep_QR()). It is the common part of the covariance-driven SSI 
+    functions.
+    
+    ----------
+    Parameters
+    ----------
+    R_is : 3D array
+        Correlation matrices (2*br+1 x N°outputs x N°columns of each block).
+    br : integer
+        The number of block rows (time shifts).
+    ordmax : integer
+        The maximum model order.
+    method, svd_method :
+        See SSIcov().
+        
+    -------
+    Returns
+    -------
+    sweep : tuple
+        See _sweep_QR().
+    O : 2D array
+        Observability matrix (at the maximum order).
+    '''
+    
+    nr = R_is.shape[1] # Number of outputs
+    
+    # Assembling the Toepliz matrix and the one-lag shifted Toeplitz matrix
+    # (used in "NExT-ERA" method)
+    Tb, Tb2 = _block_toeplitz(R_is, br)
+    
+
+    # SINGULAR VALUE DECOMPOSITION
+    U1, S1, V1_t = _svd_trunc(Tb, ordmax, svd_method)
+    S1rad=np.sqrt(S1)
+    
+    O = U1 * S1rad # Observability matrix (at the maximum order)
+    # _GAM = S1rad[:,None] * V1_t # Controllability matrix
+    
+    # One QR factorization of the shifted observability matrix, the lower 
+    # orders are obtained from the leading sub-blocks
+    if method == '2': # Method 2 "NExT-ERA"
+        # A = S1^-1/2 @ U1.T @ Tb2 @ V1 @ S1^-1/2
+        sweep = _sweep_QR(np.diag(S1rad), (U1.T @ Tb2 @ V1_t.T) / S1rad)
+    else: # Method 1 (BALANCED_REALIZATION)
+        sweep = _sweep_QR(O[:O.shape[0] - nr,:], O[nr:,:])
+    
+    return sweep, O
+
+#------------------------------------------------------------------------------
+
+
+def SSIcov(data, fs, br, ordmin=0, ordmax=None, lim=(0.01,0.05,0.02,0.1), 
+                  method='1', corr_method='direct', svd_method='full', n_jobs=1, 
+                  backend='thread', ref_channels=None):
+    '''
+    This function perform the covariance-driven Stochastic sub-Space 
+    Identification algorithm.
+    
+    The function returns a dictionary that contains the results needed
+    by the functions SSImodEX() and SSIStaDiagPlot(). No plot is produced 
+    (matplotlib is not needed), see SSIcovStaDiag() for the Stabilization 
+    Diagram.
+    
+    ----------
+    Parameters
+    ----------
+    data : 2D array
+        The time history records (N°data points x N°channels).
+    fs : float
+        The sampling frequency.
+    br : integer
+        The number of block rows (time shifts).
+    ordmax : None or integer
+        The maximum model order to use in the construction of the 
+        stabilisation diagram. None (default) is equivalent to the maximum 
+        allowable model order equal to br*data.shape[1] (br*len(ref_channels)
+        if the reference channels are given).
+    lim : tuple
+        Limit values to use for the stability requirements of the poles. The 
+        first three values are used to check the stability of the poles.
+            - Frequency: (f(n)-f(n+1))/f(n) < lim[0] (default to 0.01)
+            - Damping: (xi(n)-xi(n+1))/xi(n) < lim[1] (default to 0.05)
+            - Mode shape: 1-MAC((phi(n),phi(n+1)) < lim[2] (default to 0.02)
+        The last value (lim[3]) is used to remove all the poles that have a
+        higher damping ratio (default to 0.1, N.B. in structural dynamics
+        we usually deal with underdamped system)
+
+    method : "1" or "2"
+        Method to use in the estimation of the state matrix A:
+            - method "1" (default) : the first method takes advantages of the 
+                                     shift structrure of the observability
+                                     matrix.
+            - method "2" : the second method is based on the decomposition 
+                           property of the one-lag shifted Toeplitz matrix.
+    corr_method : "direct" or "fft"
+        Method used to estimate the correlation matrices:
+            - "direct" (default) : one matrix product for each time lag.
+            - "fft" : all the time lags are computed at once via (zero padded,
+                      block-wise) real FFTs. Much faster for large br.
+    svd_method : "full", "randomized" or "arpack"
+        Algorithm used for the singular value decomposition. Only the first
+        ordmax singular values and vectors are computed:
+            - "full" (default) : dense SVD.
+            - "randomized" : randomized SVD (range finder plus power 
+                             iterations).
+            - "arpack" : truncated SVD through the Lanczos algorithm 
+                         (ARPACK).
+        The truncated methods are much faster when ordmax is small compared
+        to br*N°channels.
+    n_jobs : integer
+        Number of workers used to compute the state matrices, the poles 
+        and the mode shapes of the different model orders. Default to 1 
+        (sequential), -1 uses all the available CPUs. The BLAS threads of 
+        the workers are limited to one (if threadpoolctl is installed).
+    backend : "thread" or "process"
+        Pool of workers used when n_jobs is not 1. Default to "thread".
+    ref_channels : None or list
+        Indices of the reference channels (SSI-cov/ref). If given, all the 
+        channels are correlated only with the reference channels, so that 
+        the Toeplitz matrix is (br*N°channels x br*N°references). None 
+        (default) uses all the channels as references.
+    -------
+    Returns
+    -------
+    Results : dictionary
+        Dictionary of results (poles and mode shapes).
+        This dictionary will be passed as argument to the SSImodEX() and 
+        SSIStaDiagPlot() functions.
+    '''
+    
+    nch=int(data.shape[1]) # Number of channel
+    br = int(br)
+    # If the maximum order is not given (default) it is set as the maximum
+    # allowable model order which is: number of block rows * number of channels
+    if ordmax == None:
+        ordmax = br*(nch if ref_channels is None else len(ref_channels))
+    
+# =============================================================================
+    # Calculating R[i] (with i from 0 to 2*br)
+    R_is = _corr(data, br*2+1, ref=ref_channels, corr_method=corr_method)
+    
+    # Toeplitz matrices, observability matrix and state matrices
+    sweep, O = _SSIcov_sweep(R_is, br, ordmax, method, svd_method)
+    
 # =============================================================================
-# Flatten everything
-    _x = Fr.flatten(order='f')
-    _y = np.array([_i//len(Fr) for _i in range(len(_x))])
-    _l = Fr_lab.flatten(order='f')
-    _d = Sm.flatten(order='f')
-    # Creating a dataframe out of the flattened results
-    df = pd.DataFrame(dict(Frequency=_x, Order=_y, Label=_l, Damp=_d))
+    # Poles and mode shapes for all the orders (possibly in parallel), 
+    # labels and tables of the poles
+    df1, df2, Ms = _SSI_poles(sweep, O[:nch,:], fs, ordmin, ordmax, lim, 
+                              n_jobs, backend)
+    
+    Results={}
+    # if ordmin == None:
+    #     ordmin = 0
+    Results['Data'] = {'Data': data}
+    Results['Data']['Samp. Freq.'] = fs
+    Results['Data']['Ord min max'] = (ordmin, ordmax)
+    Results['Data']['Block rows'] = br
+    
+    Results['All Poles'] = df1
+    Results['Reduced Poles'] = df2
+    Results['Modes'] = Ms
+   
+    return Results
+
+
+#------------------------------------------------------------------------------
+
+def SSIcovStaDiag(data, fs, br, ordmin=0, ordmax=None, lim=(0.01,0.05,0.02,0.1), 
+                  method='1', **kwargs):
+    '''
+    This function perform the covariance-driven Stochastic sub-Space 
+    Identification algorithm (see SSIcov()).
+    
+    The function returns the Stabilization Diagram (Plot) for the given
+    data. Furthermore it returns a dictionary that contains the results needed
+    by the function SSImodEX().
+    
+    ----------
+    Parameters
+    ----------
+    data, fs, br, ordmin, ordmax, lim, method :
+        See SSIcov().
+    **kwargs : 
+        Other optional arguments passed to SSIcov().
+    -------
+    Returns
+    -------
+    fig1 : matplotlib figure
+        Stabilisation diagram. 
+        Take advantage of the mplcursors module to identify the stable poles.
+    Results : dictionary
+        Dictionary of results.
+        This dictionary will be passed as argument to the SSImodEX() function.
+    '''
+    
+    Results = SSIcov(data, fs, br, ordmin=ordmin, ordmax=ordmax, lim=lim, 
+                     method=method, **kwargs)
+    fig1 = SSIStaDiagPlot(Results)
+   
+    return fig1, Results
+
+
+#------------------------------------------------------------------------------
+
+def _setup_corr(data, nlag, ref, corr_method='direct'):
+    '''
+    This function returns the reference-based correlation matrices of one 
+    setup (see _corr()). It is the task executed by the workers of 
+    SSIcovMultiSetup().
+    '''
+    
+    return _corr(np.asarray(data), nlag, ref=list(ref), corr_method=corr_method)
+
+#------------------------------------------------------------------------------
+
+
+def SSIcovMultiSetup(data, fs, br, ref_ind, ordmin=0, ordmax=None, 
+                     lim=(0.01,0.05,0.02,0.1), method='1', corr_method='direct',
+                     svd_method='full', n_jobs=1, backend='thread'):
+    '''
+    This function perform the covariance-driven Stochastic sub-Space 
+    Identification algorithm on multiple setups (roving sensors) that share 
+    a set of reference channels.
+    
+    The setups are merged before the identification (PreGER approach): for 
+    each setup the correlations of all its channels with its reference 
+    channels are computed (the setups are processed in parallel). The 
+    correlations of each setup are then scaled (least squares) so that 
+    their reference part matches the one of the first setup, and a single
+    set of correlations is assembled, with the reference channels (mean of 
+    the setups) followed by the roving (non reference) channels of each 
+    setup. The global system is finally identified as in SSIcov(), so that 
+    the mode shapes are obtained directly for all the measured points.
+    The raw data of the different setups are never concatenated.
+    
+    ----------
+    Parameters
+    ----------
+    data : list of 2D arrays
+        The time history records of each setup (N°data points x N°channels),
+        the setups can have different lengths and number of channels.
+    fs : float
+        The sampling frequency (the same for all the setups).
+    br : integer
+        The number of block rows (time shifts).
+    ref_ind : list of lists
+        Indices of the reference channels in each setup (the references must
+        be given in the same order in all the setups).
+    ordmax : None or integer
+        The maximum model order to use in the construction of the 
+        stabilisation diagram. None (default) is equivalent to the maximum 
+        allowable model order equal to br*N°references.
+    ordmin, lim, method, corr_method, svd_method, n_jobs, backend :
+        See SSIcov(). n_jobs and backend are also used for the calculation 
+        of the correlations of the setups.
+    -------
+    Returns
+    -------
+    Results : dictionary
+        Dictionary of results (poles and mode shapes), see SSIcov().
+        Results['Data']['Channels'] (N°global channels x 2) contains, for 
+        each row of the mode shapes, the setup and the channel index in the
+        setup (the reference channels are given for the first setup).
+    '''
+    
+    nsetup = len(data)
+    br = int(br)
+    nref = len(ref_ind[0])
+    # Roving (non reference) channels of each setup
+    mov_ind = [np.setdiff1d(np.arange(np.shape(data[_j])[1]), ref_ind[_j]) 
+               for _j in range(nsetup)]
+    
+    if ordmax == None:
+        ordmax = br*nref
     
 # =============================================================================
-    # Reduced dataframe (without nans) where the modal info is saved
-    df1 = df.copy()
-    df1 = df1.dropna()
-    emme = []
-    # here I look for the index of the shape associated to a given pole
-    for effe,order in zip(df1.Frequency,df1.Order):
-        emme.append(np.nanargmin(abs(effe - Fr[:, order]))) # trovo l'indice 
-    # append the list of indexes to the dataframe
-    emme = np.array(emme)
-    df1['Emme'] = emme
+    # Reference-based correlations of each setup (possibly in parallel)
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = min(int(n_jobs), nsetup)
+    _args = (data, [br*2+1]*nsetup, ref_ind, [corr_method]*nsetup)
+    if n_jobs <= 1:
+        R_setup = list(map(_setup_corr, *_args))
+    elif backend == 'process':
+        with ProcessPoolExecutor(max_workers=n_jobs) as _ex:
+            R_setup = list(_ex.map(_setup_corr, *_args))
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as _ex:
+            if threadpool_limits is None:
+                R_setup = list(_ex.map(_setup_corr, *_args))
+            else:
+                with threadpool_limits(limits=1):
+                    R_setup = list(_ex.map(_setup_corr, *_args))
+    
+    # Scaling of the setups (least squares fit of the reference part on the 
+    # one of the first setup)
+    _Rref1 = R_setup[0][:, ref_ind[0], :]
+    for _j in range(nsetup):
+        _Rref = R_setup[_j][:, ref_ind[_j], :]
+        R_setup[_j] = R_setup[_j] * (np.sum(_Rref1*_Rref) / np.sum(_Rref**2))
+    
+    # Global correlations: reference channels, then roving channels
+    R_is = np.concatenate(
+        [np.mean([R_setup[_j][:, ref_ind[_j], :] for _j in range(nsetup)], axis=0)] +
+        [R_setup[_j][:, mov_ind[_j], :] for _j in range(nsetup)], axis=1)
+    nch = R_is.shape[1] # Number of global channels
+    
+    Channels = np.array([(0, _c) for _c in ref_ind[0]] + 
+                        [(_j, _c) for _j in range(nsetup) for _c in mov_ind[_j]], 
+                        dtype=int).reshape(-1, 2)
+    
+    # Toeplitz matrices, observability matrix and state matrices
+    sweep, O = _SSIcov_sweep(R_is, br, ordmax, method, svd_method)
+    
 # =============================================================================
-    df2 = df1.copy()
-    # removing the poles that have damping exceding the limit value
-    df2.Frequency = df2.Frequency.where(df2.Damp < lim_s1) 
-    # removing the poles that have negative damping 
-    df2.Frequency = df2.Frequency.where(df2.Damp > 0)
+    # Poles and mode shapes for all the orders (possibly in parallel), 
+    # labels and tables of the poles
+    df1, df2, Ms = _SSI_poles(sweep, O[:nch,:], fs, ordmin, ordmax, lim, 
+                              n_jobs, backend)
+    
+    Results={}
+    Results['Data'] = {'Data': data}
+    Results['Data']['Samp. Freq.'] = fs
+    Results['Data']['Ord min max'] = (ordmin, ordmax)
+    Results['Data']['Block rows'] = br
+    Results['Data']['Channels'] = Channels
+    
+    Results['All Poles'] = df1
+    Results['Reduced Poles'] = df2
+    Results['Modes'] = Ms
+   
+    return Results
+
+#------------------------------------------------------------------------------
+
+def SSIStaDiagPlot(Results):
+    '''
+    This function plots the Stabilization Diagram from the results of the 
+    SSIdat() or SSIcov() functions.
+    
+    ----------
+    Parameters
+    ----------
+    Results : dictionary
+        Dictionary of results obtained either from SSIdat() or from
+        SSIcov().
+        
+    -------
+    Returns
+    -------
+    fig1 : matplotlib figure
+        Stabilisation diagram. 
+        Take advantage of the mplcursors module to identify the stable poles.
+    '''
     
+    import matplotlib.pyplot as plt
+    from matplotlib.ticker import (MultipleLocator, FormatStrFormatter)
+    import seaborn as sns
+    import mplcursors
     
-    # Physical poles compare in pairs (complex + conjugate) 
-    # I look for the poles that DO NOT have a pair and I remove them from the dataframe
-    df3 = df2.Frequency.drop_duplicates(keep=False) 
-    df2 = df2.where(~(df2.isin(df3))) # 
-    df2 = df2.dropna()# Dropping nans
-    df2 = df2.drop_duplicates(subset='Frequency') # removing conjugates
+    df2 = Results['Reduced Poles']
+    fs = Results['Data']['Samp. Freq.']
+    ordmin, ordmax = Results['Data']['Ord min max']
+    br = Results['Data']['Block rows']
     
+    freq_max = fs/2 # Nyquist Frequency
     
     # df4 = df4.where(df2.Order > ordmin).dropna() # Tengo solo i poli sopra ordmin
     # assigning colours to the labels
@@ -718,24 +1461,39 @@ def SSIcovStaDiag(data, fs, br, ordmin=0, ordmax=None, lim=(0.01,0.05,0.02,0.1),
     ax1.set_xlabel('Frequency [Hz]')
     mplcursors.cursor()
     # plt.show()
-    
-    Results={}
-    # if ordmin == None:
-    #     ordmin = 0
-    Results['Data'] = {'Data': data}
-    Results['Data']['Samp. Freq.'] = fs
-    Results['Data']['Ord min max'] = (ordmin, ordmax)
-    Results['Data']['Block rows'] = br
-    
-    Results['All Poles'] = df1
-    Results['Reduced Poles'] = df2
-    Results['Modes'] = Ms
    
-    return fig1, Results
+    return fig1
 
 
 #------------------------------------------------------------------------------
 
+def _pole_shapes(Ms, tab):
+    '''
+    This function gathers the mode shapes of the poles of a table (see 
+    _pole_table()) in a single array, one shape for each row.
+    
+    ----------
+    Parameters
+    ----------
+    Ms : list
+        Mode shapes (Results['Modes']), one array for each order.
+    tab : structured array
+        Table of the poles.
+        
+    -------
+    Returns
+    -------
+    shapes : 2D array
+        Mode shapes by rows (N°poles x N°channels).
+    '''
+    
+    _offset = np.concatenate(([0], np.cumsum([_m.shape[1] for _m in Ms])))
+    shapes = np.hstack(Ms).T[_offset[tab['Order']] + tab['Emme']]
+    
+    return shapes
+
+#------------------------------------------------------------------------------
+
 
 def SSIModEX(FreQ, Results, deltaf=0.05, aMaClim=0.95):
     '''
@@ -773,38 +1531,31 @@ def SSIModEX(FreQ, Results, deltaf=0.05, aMaClim=0.95):
     df2 = Results['Reduced Poles']
     Ms = Results['Modes'] 
     
+    # Mode shapes of all the (reduced) poles, gathered by rows in one array
+    _allshapes = _pole_shapes(Ms, df2)
+    # Sorted-frequency index of the poles
+    _sort = np.argsort(df2['Frequency'], kind='stable')
+    _fsort = df2['Frequency'][_sort]
+    
     Freq = []
     Damp = []
     Fi = []
     for _x in FreQ:
         xmeno1, xpiu1 = _x-deltaf, _x+deltaf # tolerance limit 
-        # saving only the poles whithin the limts
-        df3 = df2.copy
-        df3 = df2.where((df2.Frequency < xpiu1) & (df2.Frequency > xmeno1))
-        df3 = df3.dropna()
+        # saving only the poles whithin the limts (xmeno1 < f < xpiu1)
+        _lo = np.searchsorted(_fsort, xmeno1, side='right')
+        _hi = np.searchsorted(_fsort, xpiu1, side='left')
+        _band = np.sort(_sort[_lo:_hi]) # (same order as the table)
+        df3 = df2[_band]
         
-        npoli = len(df3['Frequency'].values) # number of poles
-        
-        AutoMacche = np.zeros((npoli, npoli),dtype=complex) # initialization
-        # Looping throug the extracted poles to calculate the autoMAC
-        # matrix (between the poles)
-        for b in range(npoli): # first loop
-            zuno = int(df3['Order'].values[b]) # index 1 of the mode shape
-            fiuno = Ms[zuno][:,int(df3['Emme'].values[b])] # shape 1
-            for k in range(npoli): # secondo loop
-                zdue = int(df3['Order'].values[k]) # index 1 of the mode shape 
-                fidue = Ms[zdue][:,int(df3['Emme'].values[k])] # shape 2
-                    
-                AutoMacche[b, k] = MaC(fiuno,fidue) # MaC between every pole
+        # autoMAC matrix (between the poles)
+        _shapes = _allshapes[_band]
+        AutoMacche = MaC_batch(_shapes, _shapes)
         # I look for the pole that have the highest sum of macs
         SAmaC = np.sum(AutoMacche, axis=1) #adding up every value on a column
         idxmax = np.argmax(SAmaC) # 
         
-        # Index 1 of reference shape
-        MSrefidx1 = int(df3['Order'].values[idxmax])
-        # Index 2 of reference shape
-        MSrefidx2 = int(df3['Emme'].values[idxmax])
-        firef = Ms[MSrefidx1][:,MSrefidx2] # Reference shape
+        firef = _shapes[idxmax] # Reference shape
         
         idmax = np.argmax(abs(firef))
         firef = firef/firef[idmax] # normalised (unity displacement)
@@ -812,14 +1563,12 @@ def SSIModEX(FreQ, Results, deltaf=0.05, aMaClim=0.95):
 
         # keeping only the poles that have MAC > MAClim value
         AMaC = AutoMacche[idxmax]
-        df3['AMaC'] = AMaC
-        df3 = df3.where(df3.AMaC > aMaClim)
-        df3 = df3.dropna()
+        df3 = df3[AMaC > aMaClim]
         
-        FrMean = df3.Frequency.mean() # Mean frequency
-        # FrStd = df3.Frequency.std() # dev.std.
-        DampMean = df3.Damp.mean() # Mean damping
-        # DampStd = df3.Damp.std() # dev.std. 
+        FrMean = df3['Frequency'].mean() # Mean frequency
+        # FrStd = df3['Frequency'].std() # dev.std.
+        DampMean = df3['Damp'].mean() # Mean damping
+        # DampStd = df3['Damp'].std() # dev.std. 
         
         Freq.append(FrMean)
         Damp.append(DampMean)
@@ -837,18 +1586,330 @@ def SSIModEX(FreQ, Results, deltaf=0.05, aMaClim=0.95):
     return Results
 
 #------------------------------------------------------------------------------
+
+
+def SSIAutoModEX(Results, dlim=0.05, labels=(4,), nmin=None, nneigh=50):
+    '''
+    This function automatically extracts the modal properties (frequencies, 
+    damping ratios, mode shapes) by clustering the stable poles of the 
+    stabilisation diagram, without the need of a list of frequencies.
+    
+    The poles are grouped by single-linkage hierarchical clustering, with 
+    the distance between two poles i and j defined as:
+        d_ij = |lambda_i - lambda_j|/max(|lambda_i|, |lambda_j|) + 1 - MAC_ij
+    where lambda is the (continuous time) pole, so that the first term 
+    accounts for both frequency and damping. The dendrogram is cut at the 
+    distance dlim.
+    Since d_ij is greater than the relative difference of the frequencies,
+    only the poles within a sorted-frequency window (and at most nneigh
+    neighbours on each side) are compared, and no dense distance matrix is 
+    ever formed. The clusters are the connected components of the resulting
+    sparse graph.
+    One mode is returned for each cluster with at least nmin poles.
+    
+    ----------
+    Parameters
+    ----------
+    Results : dictionary
+        Dictionary of results obtained either from SSIdat() or from SSIcov()
+        (or SSIdatStaDiag()/SSIcovStaDiag()).
+    dlim : float
+        Distance limit used to cut the dendrogram. Default to 0.05.
+    labels : tuple
+        Labels of the poles to cluster (see SSIcovStaDiag()). Default to 
+        (4,), i.e. only the stable poles.
+    nmin : None or integer
+        Minimum number of poles of a cluster. None (default) is equivalent 
+        to 20% of the number of model orders of the stabilisation diagram.
+    nneigh : integer
+        Maximum number of neighbours (in frequency, on each side) compared 
+        with each pole. Default to 50.
+
+    -------
+    Returns
+    -------
+    Results : dictionary
+        Dictionary containing the modal properties (frequencies, damping
+        ratios, mode shapes) of the system, and the statistics of the 
+        clusters:
+            - Results['Cluster']['N. poles'] : number of poles
+            - Results['Cluster']['Freq. std'] : std. dev. of the frequency
+            - Results['Cluster']['Damp. std'] : std. dev. of the damping
+            - Results['Cluster']['MAC mean'] : mean MAC with the reference 
+              shape
+    '''
+    
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    
+    df2 = Results['Reduced Poles']
+    Ms = Results['Modes'] 
+    
+    if nmin is None:
+        nmin = max(2, int(0.2*len(Ms)))
+    
+    # Stable poles, sorted by frequency
+    tab = df2[np.isin(df2['Label'], labels)]
+    tab = tab[np.argsort(tab['Frequency'], kind='stable')]
+    npoli = len(tab)
+    
+    _f = tab['Frequency']
+    _xi = tab['Damp']
+    _lam = 2*np.pi*_f*(-_xi + 1j*np.sqrt(1 - _xi**2)) # continuous time poles
+    _shapes = _pole_shapes(Ms, tab)
+    
+    # Upper limit of the frequency window of each pole
+    _hi = np.searchsorted(_f, _f/(1 - dlim), side='left')
+    
+    # Sparse (neighbour-limited) graph of the poles closer than dlim
+    _rows, _cols = [], []
+    for _k in range(1, nneigh+1):
+        _i = np.arange(npoli - _k)
+        _i = _i[_i + _k < _hi[_i]] # pairs (i, i+k) within the window
+        if len(_i) == 0:
+            break
+        _j = _i + _k
+        _dist = abs(_lam[_i] - _lam[_j]) / np.maximum(abs(_lam[_i]), abs(_lam[_j])) \
+            + 1 - MaC_batch(_shapes[_i, None, :], _shapes[_j, None, :])[:, 0, 0]
+        _rows.append(_i[_dist < dlim])
+        _cols.append(_j[_dist < dlim])
+    _rows = np.concatenate([np.zeros(0, dtype=int)] + _rows)
+    _cols = np.concatenate([np.zeros(0, dtype=int)] + _cols)
+    _graph = coo_matrix((np.ones(len(_rows)), (_rows, _cols)), shape=(npoli, npoli))
+    
+    # Single-linkage clusters (connected components of the graph)
+    _ncl, _clid = connected_components(_graph, directed=False)
+    _size = np.bincount(_clid, minlength=_ncl)
+    
+    Freq = []
+    Damp = []
+    Fi = []
+    Npoles = []
+    FrStd = []
+    DampStd = []
+    MaCMean = []
+    for _c in np.flatnonzero(_size >= nmin):
+        _idx = np.flatnonzero(_clid == _c)
+        _sh = _shapes[_idx]
+        # Reference shape: the one with the highest sum of MAC with the other
+        # shapes of the cluster (computed through the sum of the projectors)
+        _shn = _sh / np.linalg.norm(_sh, axis=1)[:, None]
+        _proj = _shn.T @ _shn.conj()
+        SAmaC = np.einsum('ki,ij,kj->k', _shn.conj(), _proj, _shn).real
+        idxmax = np.argmax(SAmaC)
+        firef = _sh[idxmax]
+        idmax = np.argmax(abs(firef))
+        firef = firef/firef[idmax] # normalised (unity displacement)
+        
+        Freq.append(_f[_idx].mean())
+        Damp.append(_xi[_idx].mean())
+        Fi.append(firef)
+        Npoles.append(len(_idx))
+        FrStd.append(_f[_idx].std())
+        DampStd.append(_xi[_idx].std())
+        MaCMean.append(SAmaC[idxmax]/len(_idx))
+    
+    Freq = np.array(Freq, dtype=float)
+    Damp = np.array(Damp, dtype=float)
+    # (empty results if no cluster has at least nmin poles)
+    Fi = np.array(Fi) if len(Fi) else np.zeros((0, _shapes.shape[1]), dtype=complex)
+    
+    Results={}
+    Results['Frequencies'] = Freq
+    Results['Damping'] = Damp
+    Results['Mode Shapes'] = Fi.T
+    Results['Cluster'] = {'N. poles': np.array(Npoles, dtype=int), 
+                          'Freq. std': np.array(FrStd, dtype=float),
+                          'Damp. std': np.array(DampStd, dtype=float),
+                          'MAC mean': np.array(MaCMean, dtype=float)}
+        
+    return Results
+
+#------------------------------------------------------------------------------
+
+def _PSD_nch(PSD_matr):
+    '''
+    This function returns the number of channels of a PSD matrix, either full
+    (N°channels x N°channels x N°freq. lines) or packed (see PSD_pack()).
+    '''
+    
+    if PSD_matr.ndim == 3:
+        return PSD_matr.shape[0]
+    return int(round((np.sqrt(8*PSD_matr.shape[0] + 1) - 1)/2))
+
+#------------------------------------------------------------------------------
+
+def PSD_pack(PSD_matr):
+    '''
+    This function converts the (Hermitian) PSD matrix to the packed format, 
+    where only the upper triangular part is stored. The rows of the packed
+    matrix are the elements (i,j), with i<=j, in the order given by 
+    numpy.triu_indices(N°channels).
+    
+    ----------
+    Parameters
+    ----------
+    PSD_matr : 3D array
+        PSD matrix (N°channels x N°channels x N°freq. lines).
+        
+    -------
+    Returns
+    -------
+    PSD_matr : 2D array
+        Packed PSD matrix (N°channels*(N°channels+1)/2 x N°freq. lines).
+    '''
+    
+    if PSD_matr.ndim == 2: # already packed
+        return PSD_matr
+    _iu, _ju = np.triu_indices(PSD_matr.shape[0])
+    
+    return PSD_matr[_iu, _ju]
+
+#------------------------------------------------------------------------------
+
+def PSD_unpack(PSD_matr, sl=slice(None)):
+    '''
+    This function returns the full PSD matrix at the frequency line(s) sl, 
+    expanding it if it is in the packed format (see PSD_pack()).
+    
+    ----------
+    Parameters
+    ----------
+    PSD_matr : 2D or 3D array
+        PSD matrix, packed or full.
+    sl : integer or slice
+        Frequency line (or lines) to return. Default to all the lines.
+        
+    -------
+    Returns
+    -------
+    PSD : 2D or 3D array
+        Full PSD matrix (N°channels x N°channels x N°lines), or 
+        (N°channels x N°channels) if sl is an integer.
+    '''
+    
+    if PSD_matr.ndim == 3: # already full
+        return PSD_matr[:, :, sl]
+    nch = _PSD_nch(PSD_matr)
+    _iu, _ju = np.triu_indices(nch)
+    _P = PSD_matr[:, sl]
+    
+    PSD = np.zeros((nch, nch) + _P.shape[1:], dtype=_P.dtype)
+    PSD[_ju, _iu] = _P.conj() # lower triangular part
+    PSD[_iu, _ju] = _P # upper triangular part (and diagonal)
+    
+    return PSD
+
+#------------------------------------------------------------------------------
+
+def _welch_sums(data, nxseg, step, nseg, win, chunk=None, detrend=False, 
+                packed=False):
+    '''
+    This function computes the sum, over the segments, of the cross-spectra
+    X_i*conj(X_j) of the windowed segments of the data (Welch estimator). The
+    data are read in blocks of chunk segments (so that data can also be a 
+    numpy.memmap), the FFT of all the segments and channels of a block is 
+    computed in a single call and the cross-spectra are accumulated with one
+    (batched) matrix product or, in the packed format, only for the pairs 
+    i<=j of the upper triangular part (with a Hermitian rank-k update for 
+    each frequency line).
+    
+    ----------
+    Parameters
+    ----------
+    data : 2D array (or numpy.memmap)
+        The time history records (N°data points x N°channels).
+    nxseg : integer
+        Number of points per segment.
+    step : integer
+        Distance (in points) between the beginning of two segments.
+    nseg : integer
+        Number of segments.
+    win : 1D array
+        Window (nxseg points).
+    chunk : None or integer
+        Number of segments processed at once. None (default) uses blocks of
+        about 2**22 data points.
+    detrend : True or False
+        Whether to remove the mean from each segment. Default to False.
+    packed : True or False
+        Whether to accumulate (and return) only the upper triangular part, in 
+        the packed format (see PSD_pack()). Default to False.
+        
+    -------
+    Returns
+    -------
+    S : 3D (or 2D) array
+        Sum of the cross-spectra (N°channels x N°channels x N°freq. lines), or
+        (N°channels*(N°channels+1)/2 x N°freq. lines) if packed.
+    '''
+    
+    nch = data.shape[1]
+    if chunk is None:
+        chunk = max(1, 2**22 // (nch*nxseg))
+
+    if packed:
+        S = np.zeros((nch*(nch+1)//2, nxseg//2 + 1), dtype=complex)
+        # positions of the pairs (i, j>=i) in the (Fortran ordered) lower 
+        # triangular part returned by the Hermitian rank-k update
+        _iu = np.ravel_multi_index(np.triu_indices(nch), (nch, nch))
+    else:
+        S = np.zeros((nxseg//2 + 1, nch, nch), dtype=complex)
+    for _j in range(0, nseg, chunk):
+        _nb = min(chunk, nseg - _j) # number of segments in the block
+        _block = np.asarray(data[_j*step : (_j + _nb - 1)*step + nxseg], dtype=float)
+        # Segments of the block (strided view, no copy)
+        _segs = np.lib.stride_tricks.sliding_window_view(_block, nxseg, axis=0)[::step] # (N°segments x N°ch x nxseg)
+        if detrend:
+            _segs = _segs - _segs.mean(axis=2, keepdims=True)
+        X = np.fft.rfft(win*_segs, axis=2).transpose(2, 1, 0) # (N°freq. lines x N°ch x N°segments)
+        if packed:
+            X = X.copy() # so that X[f].T is Fortran ordered (no copy by BLAS)
+            # pairs (i, j>=i) of each frequency line with a Hermitian rank-k 
+            # update (BLAS herk), computing only one triangular part: the 
+            # lower part of X^H @ X (X.T being N°segments x N°ch) is 
+            # X_i*conj(X_j) for j>=i
+            for _f in range(len(X)):
+                S[:, _f] += LA.blas.zherk(1.0, X[_f].T, trans=2, lower=1).ravel(order='F')[_iu]
+        else:
+            S += X @ X.conj().transpose(0, 2, 1)
+    
+    if not packed:
+        S = np.moveaxis(S, 0, 2) # (N°ch x N°ch x N°freq. lines)
+    
+    return S
+
+#------------------------------------------------------------------------------
+
+def _PSD_qform(PSD_matr, fi):
+    '''
+    This function returns the quadratic form fi^H @ PSD @ fi of the PSD 
+    matrix (full or packed, see PSD_pack()) for all the frequency lines.
+    '''
+    
+    if PSD_matr.ndim == 3:
+        return np.einsum('i,ijl,j->l', fi.conj(), PSD_matr, fi)
+    _iu, _ju = np.triu_indices(len(fi))
+    _w = fi.conj()[_iu]*fi[_ju] # weights of the upper triangular elements
+    _off = _iu != _ju
+    # the lower triangular part is the complex conjugate of the upper one
+    return (_w[~_off] @ PSD_matr[~_off]).real + 2*(_w[_off] @ PSD_matr[_off]).real
+
+#------------------------------------------------------------------------------
     
-def PSD_welch(data, fs, df=0.01, pov=0.5, window='hann'):
+def PSD_welch(data, fs, df=0.01, pov=0.5, window='hann', packed=False, chunk=None):
     """
     This function calculate the Power Spectral Density (PSD) matrix of the 
     signals according to the Periodogram approach (Welch estimator). 
-    (N.B. This function uses SciPy's "scipy.signal.csd" function. The function
-     has sometimes crashed when using big datasets)
+    (N.B. This function gives the same results of SciPy's "scipy.signal.csd" 
+     function (constant detrend of the segments, one-sided density scaling),
+     but the data are processed in blocks of segments, so that the memory 
+     needed does not depend on the length of the records)
 
     ----------
     Parameters
     ----------
-    data : 2D array
+    data : 2D array (or numpy.memmap)
         The time history records (N°data points x N°channels).
     fs : float
         The sampling frequency.
@@ -860,6 +1921,12 @@ def PSD_welch(data, fs, df=0.01, pov=0.5, window='hann'):
         Desired window to use. Window is passed to scipy.signal's get_window
         function (see SciPy.org for more info). Default to "hann" which stands
         for a “Hanning” window.
+    packed : True or False
+        Whether to return the PSD matrix in the packed (upper triangular) 
+        format (see PSD_pack()). Default to False.
+    chunk : None or integer
+        Number of segments processed at once. None (default) uses blocks of
+        about 2**22 data points.
 
     -------
     Returns
@@ -873,19 +1940,24 @@ def PSD_welch(data, fs, df=0.01, pov=0.5, window='hann'):
                 Results['freq'] = freq_hz 
     """
     ndat = data.shape[0]  # Number of data points
-    nch = data.shape[1]  # Number of channels
-    nxseg = fs / df  # number of point per segments
-    noverlap = nxseg // (1 / pov)  # Number of overlapping points
-
-    # Calculating Auto e Cross-Spectral Density
-    freq_hz, PSD_matr = signal.csd(
-        data.T.reshape(nch, 1, ndat),
-        data.T.reshape(1, nch, ndat),
-        fs=fs,
-        nperseg=nxseg,
-        noverlap=noverlap,
-        window=window,
-    )
+    nxseg = int(fs / df)  # number of point per segments
+    noverlap = int(nxseg // (1 / pov))  # Number of overlapping points
+    step = nxseg - noverlap # distance between the segments
+    nseg = (ndat - noverlap) // step # number of segments
+    if isinstance(window, (str, tuple)):
+        win = signal.get_window(window, nxseg)
+    else:
+        win = np.asarray(window)
+    
+    freq_hz = np.fft.rfftfreq(nxseg, 1/fs)
+    
+    # Calculating Auto e Cross-Spectral Density, conj(X_i)*X_j averaged over
+    # the segments
+    PSD_matr = _welch_sums(data, nxseg, step, nseg, win, chunk, detrend=True, 
+                           packed=packed)
+    np.conjugate(PSD_matr, out=PSD_matr)
+    PSD_matr /= fs*(win**2).sum()*nseg # density scaling
+    PSD_matr[..., 1:(nxseg+1)//2] *= 2 # one-sided spectrum (DC and Nyquist excluded)
     
     Results={}
     Results['Data'] = {'Data': data}
@@ -897,20 +1969,23 @@ def PSD_welch(data, fs, df=0.01, pov=0.5, window='hann'):
     return Results
 #------------------------------------------------------------------------------
     
-def PSD_welch1(data, fs, df=0.01, pov=0.5, window='hann'):
+def PSD_welch1(data, fs, df=0.01, pov=0.5, window='hann', packed=False, chunk=None):
     """
     This function calculate the Power Spectral Density (PSD) matrix of the 
     signals according to the Periodogram approach (Welch estimator). 
-    This function is less efficient than the previous since the calculations
-    are performed "manually" and not using the more efficient "scipy.signal.csd" 
-    function.
+    The calculations are performed "manually" and not using the 
+    "scipy.signal.csd" function: the data are segmented once (without copies),
+    the FFT of all the segments and channels of a block is computed in a 
+    single call and the cross-spectra are accumulated with one (batched) 
+    matrix product. The data are processed in blocks of segments, so that 
+    the memory needed does not depend on the length of the records.
     This function was introduced since, the other version sometime crashed
     when using big dataset. 
 
     ----------
     Parameters
     ----------
-    data : 2D array
+    data : 2D array (or numpy.memmap)
         The time history records (N°data points x N°channels).
     fs : float
         The sampling frequency.
@@ -922,6 +1997,12 @@ def PSD_welch1(data, fs, df=0.01, pov=0.5, window='hann'):
         Desired window to use. Window is passed to scipy.signal's get_window
         function (see SciPy.org for more info). Default to "hann" which stands
         for a “Hanning” window.
+    packed : True or False
+        Whether to return the PSD matrix in the packed (upper triangular) 
+        format (see PSD_pack()). Default to False.
+    chunk : None or integer
+        Number of segments processed at once. None (default) uses blocks of
+        about 2**22 data points.
 
     -------
     Returns
@@ -935,38 +2016,23 @@ def PSD_welch1(data, fs, df=0.01, pov=0.5, window='hann'):
                 Results['freq'] = freq_hz 
     """
     ndat = data.shape[0]  # Number of data points
-    nch = data.shape[1]  # Number of channels
     nxseg = int(fs / df)  # number of point per segments
     
-    freq = 2*np.pi*np.arange(0, nxseg/2 + 1)*(fs/nxseg) # Frequency vector in rad/s
+    freq = 2*np.pi*np.arange(0, nxseg//2 + 1)*(fs/nxseg) # Frequency vector in rad/s
     freq_hz = freq/(2*np.pi)
     
     n = int(np.floor((ndat - nxseg)/(nxseg*(1 - pov))))+1 # Number of windows to be applied
     win = signal.windows.hann(nxseg) # hanning window
-    Y = data.T # Transpose data
-    Sy = np.zeros((nch, nch , len(freq)), dtype=complex) # Initialise 3D matrix
-
-    # Calculating Auto e Cross-Spectral Density
-    for i in range(nch): # loop su canali (primo indice)
-        for ie in range(nch): # loop su canali (secondo indice)
-            S1 = np.zeros(nxseg)
-            index = np.arange(nxseg, dtype=int) # Intial index
-            for j in range(n): # loop su blocchi
-                X1 = win*Y[i, index[0]: (index[-1]+1)].T
-                if i==ie: # Calculate Auto-power
-                    S1 = S1 + np.fft.fft(X1, nxseg)*np.conj(np.fft.fft(X1, nxseg));
-                else: # Calculate Cross-power
-                    Y1 = win*Y[ie, index].T;
-                    S1 = S1 + np.fft.fft(X1, nxseg)*np.conj(np.fft.fft(Y1, nxseg));
-
-                index = index + int(np.floor((nxseg*(1 - pov)))) # Update index
-
-            S1 = S1/np.mean(win**2) # Compensate for windowing
-            S1 = S1[0: int((nxseg/2)+1)] # Remove second half(reflection)
-            S1 = S1/n # Average power by number of windows
-            S1 = S1/(fs*nxseg) # Normalize by sampling rate & window length
-            S1[0: ] = 2*S1[0: ] # Account for double-sided nature of FFT
-            Sy[i, ie] = S1 # Save in Output matrix
+    step = int(np.floor(nxseg*(1 - pov))) # distance between the segments
+    
+    # Calculating Auto e Cross-Spectral Density, X_i*conj(X_ie) summed over 
+    # the segments
+    Sy = _welch_sums(data, nxseg, step, n, win, chunk, packed=packed)
+    
+    Sy /= np.mean(win**2) # Compensate for windowing
+    Sy /= n # Average power by number of windows
+    Sy /= fs*nxseg # Normalize by sampling rate & window length
+    Sy *= 2 # Account for double-sided nature of FFT
     
     Results={}
     Results['Data'] = {'Data': data}
@@ -979,54 +2045,110 @@ def PSD_welch1(data, fs, df=0.01, pov=0.5, window='hann'):
 
 #------------------------------------------------------------------------------
 
-def FDDsvp(PSD_Results):
+def FDDsv(PSD_Results, n_sv=None, chunk=None):
     """
-    This function perform the Frequency Domain Decomposition algorithm.
-    The function return the plot of the singular values of the Power Spectral
-    Density (PSD). 
+    This function perform the Frequency Domain Decomposition algorithm, i.e.
+    it computes the singular values and vectors of the Power Spectral 
+    Density (PSD) matrix. No plot is produced (matplotlib is not needed), 
+    see FDDsvp() for the plot of the singular values.
     
     ----------
     Parameters
     ----------
     PSD_Results : dictionary
-        Dictionary of results containing the PSD matrix and the other relevant
-        information.
+        Dictionary of results containing the PSD matrix (full or packed) and 
+        the other relevant information.
+    n_sv : None or integer
+        Number of (leading) singular values and vectors to keep. None 
+        (default) keeps them all. FDDmodEX() needs at least 2 singular values,
+        EFDDmodEX() at least cm.
+    chunk : None or integer
+        Number of frequency lines decomposed at once. None (default) uses 
+        chunks of about 2**22 elements of the PSD matrix.
 
     Returns
     -------
-    fig1 : matplotlib figure
-        Plot of the singular values of the power spectral matrix.
     Results : dictionary
-        Dictionary of results to be passed to FDDmodEX()
+        Dictionary of results to be passed to FDDmodEX(), EFDDmodEX(), 
+        FDDpeaks() and FDDsvPlot(), where:
+            -   Results['Singular Values'] (n_sv x N°freq. lines) 
+                contains the (square root of the) singular values, in 
+                descending order;
+                Results['Singular Vectors'] (n_sv x N°channels x 
+                N°freq. lines) contains the singular vectors, with 
+                Results['Singular Vectors'][k,:,i] the k-th vector at the
+                i-th frequency line.
     """
-
+    
     PSD_matr = PSD_Results['PSD Matrix']
-    freq_hz = PSD_Results['freq']
+
+    nch = _PSD_nch(PSD_matr)
+    nxseg = PSD_matr.shape[-1]
+
+    if n_sv is None:
+        n_sv = nch
+    if chunk is None:
+        chunk = max(1, 2**22 // nch**2)
+
+    S_val = np.zeros((n_sv, nxseg)) # Singular Values
+    S_vec = np.zeros((n_sv, nch, nxseg), dtype=complex) # Singular Vectors
+    # The PSD matrix is Hermitian (positive semi-definite), so its singular 
+    # values and vectors are given by the (stacked) eigendecomposition, 
+    # computed for a chunk of frequency lines at once. Only the leading n_sv
+    # values and vectors are kept.
+    for _i in range(0, nxseg, chunk):
+        _sl = slice(_i, min(_i + chunk, nxseg))
+        S1, U1 = np.linalg.eigh(np.moveaxis(PSD_unpack(PSD_matr, _sl), 2, 0)) # (chunk x N°ch x N°ch)
+        S1 = abs(S1)
+        _ord = np.argsort(S1, axis=1)[:, ::-1][:, :n_sv] # descending order
+        S1 = np.take_along_axis(S1, _ord, axis=1)
+        U1 = np.take_along_axis(U1, _ord[:, None, :], axis=2)
+        S_val[:, _sl] = np.sqrt(S1).T
+        S_vec[:, :, _sl] = np.transpose(U1, (2, 1, 0))
+    
+    Results = PSD_Results.copy()
+    Results['Singular Values'] = S_val
+    Results['Singular Vectors'] = S_vec
     
-    fs = PSD_Results['Data']['Samp. Freq.']
-    df = PSD_Results['Data']['Freq. Resol.']
+    return Results
 
-    nch = PSD_matr.shape[0]
-    nxseg = PSD_matr.shape[2]
-    freq_max = fs / 2  # Nyquist frequency
+#------------------------------------------------------------------------------
+
+def FDDsvPlot(Results):
+    """
+    This function returns the plot of the singular values of the Power 
+    Spectral Density (PSD) matrix.
+    
+    ----------
+    Parameters
+    ----------
+    Results : dictionary
+        Dictionary of results obtained from FDDsv() (or FDDsvp()).
 
+    Returns
+    -------
+    fig1 : matplotlib figure
+        Plot of the singular values of the power spectral matrix.
+    """
+    
+    import matplotlib.pyplot as plt
+    from matplotlib.ticker import (MultipleLocator, FormatStrFormatter)
+    import mplcursors
 
-    S_val = np.zeros((nch, nch, nxseg)) # Inizializzo la matrice dove salverò i Singular Values
-    S_vec = np.zeros((nch, nch, nxseg), dtype=complex) # Inizializzo la matrice dove salverò i Singular Vectors
-    # loop dove mi calcolo i singular value      
-    for _i in range(np.shape(PSD_matr)[2]):
-        U1, S1, _V1_t = np.linalg.svd(PSD_matr[:,:,_i])
-        U1_1=np.transpose(U1) 
-        S1 = np.diag(S1)
-        S1rad=np.sqrt(S1)
-        S_val[:,:,_i] = S1rad
-        S_vec[:,:,_i] = U1_1
+    S_val = Results['Singular Values']
+    freq_hz = Results['freq']
+    
+    fs = Results['Data']['Samp. Freq.']
+    df = Results['Data']['Freq. Resol.']
+    
+    n_sv = S_val.shape[0]
+    freq_max = fs / 2  # Nyquist frequency
     
     # Plot dei singular values (in scala logaritmica)
     fig, ax = plt.subplots()
-    for _i in range(nch):
+    for _i in range(n_sv):
     #    ax.semilogy(_f, S_val[_i, _i]) # scala log
-        ax.plot(freq_hz[:], 10*np.log10(S_val[_i, _i])) # decibel
+        ax.plot(freq_hz[:], 10*np.log10(S_val[_i])) # decibel
     ax.grid()
     ax.set_xlim(left=0, right=freq_max)
     ax.xaxis.set_major_locator(MultipleLocator(freq_max/10))
@@ -1038,15 +2160,109 @@ def FDDsvp(PSD_Results):
     # ax.set_ylabel(r'dB $\left[\frac{\left(\frac{m}{s^2}\right)^2}{Hz}\right]$')    
     mplcursors.cursor()
 
-    Results = PSD_Results.copy()
-    Results['Singular Values'] = S_val
-    Results['Singular Vectors'] = S_vec
+    return fig
+
+#------------------------------------------------------------------------------
+
+def FDDsvp(PSD_Results, n_sv=None, chunk=None):
+    """
+    This function perform the Frequency Domain Decomposition algorithm (see 
+    FDDsv()).
+    The function return the plot of the singular values of the Power Spectral
+    Density (PSD). 
+    
+    ----------
+    Parameters
+    ----------
+    PSD_Results, n_sv, chunk :
+        See FDDsv().
+
+    Returns
+    -------
+    fig1 : matplotlib figure
+        Plot of the singular values of the power spectral matrix.
+    Results : dictionary
+        Dictionary of results to be passed to FDDmodEX() (see FDDsv()).
+    """
+    
+    Results = FDDsv(PSD_Results, n_sv=n_sv, chunk=chunk)
+    fig = FDDsvPlot(Results)
     
     return fig, Results
 
 #------------------------------------------------------------------------------
 
 
+def FDDpeaks(Results, fmin=None, fmax=None, prominence=3, ndf=2, MAClim=0.95, 
+             npeaks=None):
+    '''
+    This function automatically picks the peaks of the first singular value 
+    of the PSD matrix (see FDDsv(), which does not need matplotlib and does
+    not produce any figure), to be used (in place of the frequencies identified 
+    from the singular values plot) in FDDmodEX() and EFDDmodEX().
+    The peaks are searched (in dB) within the band [fmin, fmax], and only the
+    peaks with at least the given prominence are retained. A peak is then 
+    accepted only if the first singular vectors of the ndf lines on each side
+    have a MAC greater than MAClim with the one at the peak (i.e. if the peak
+    is dominated by a single mode).
+    
+    ----------
+    Parameters
+    ----------
+    Results : dictionary
+        Dictionary of results obtained from FDDsv() (or FDDsvp()).
+    fmin, fmax : None or float
+        Limits of the frequency band where the peaks are searched. None 
+        (default) means no limit.
+    prominence : float
+        Minimum prominence (in dB) of the peaks. Default to 3.
+    ndf : integer
+        Number of spectral lines, on each side of the peak, used in the MAC
+        check. Default to 2.
+    MAClim : float
+        Minimum MAC between the singular vectors of the peak and of the 
+        neighbouring lines. Default to 0.95.
+    npeaks : None or integer
+        Maximum number of peaks to return (the most prominent ones). None 
+        (default) returns all the peaks found.
+        
+    -------
+    Returns
+    -------
+    FreQ : array
+        Frequencies of the peaks, in ascending order.
+    '''
+    
+    freq_hz = Results['freq']
+    S_val = Results['Singular Values']
+    S_vec = Results['Singular Vectors']
+    
+    # Band where the peaks are searched
+    _lo = 0 if fmin is None else np.searchsorted(freq_hz, fmin, side='left')
+    _hi = len(freq_hz) if fmax is None else np.searchsorted(freq_hz, fmax, side='right')
+    
+    _peaks, _prop = signal.find_peaks(10*np.log10(S_val[0, _lo:_hi]), prominence=prominence) # decibel
+    _peaks += _lo
+    
+    # MAC check of the singular vectors of the neighbouring lines
+    _k = np.arange(-ndf, ndf+1)
+    _idx = np.clip(_peaks[:, None] + _k[None, :], 0, len(freq_hz)-1) # (N°peaks x 2*ndf+1)
+    _vec = np.moveaxis(S_vec[0][:, _idx], 0, 2) # (N°peaks x 2*ndf+1 x N°ch)
+    _mac = MaC_batch(_vec[:, ndf:ndf+1, :], _vec)[:, 0, :]
+    _ok = np.all(_mac >= MAClim, axis=1)
+    
+    _peaks = _peaks[_ok]
+    _prom = _prop['prominences'][_ok]
+    if npeaks is not None:
+        _peaks = _peaks[np.argsort(_prom, kind='stable')[::-1][:npeaks]]
+    
+    FreQ = freq_hz[np.sort(_peaks)]
+    
+    return FreQ
+
+#------------------------------------------------------------------------------
+
+
 def FDDmodEX(FreQ, Results, ndf=5):
     '''
     This function returns the modal parameters estimated according to the
@@ -1059,7 +2275,7 @@ def FDDmodEX(FreQ, Results, ndf=5):
         Array containing the frequencies, identified from the singular values
         plot, which we want to extract.
     Results : dictionary
-        Dictionary of results obtained from FDDsvp().
+        Dictionary of results obtained from FDDsv() (or FDDsvp()).
     ndf : float
         Number of spectral lines in the proximity of FreQ[i] where the peak
         is searched.
@@ -1090,7 +2306,7 @@ def FDDmodEX(FreQ, Results, ndf=5):
         lim = (_x - deltaf, _x + deltaf) # frequency bandwidth where the peak is searched
         idxlim = (np.argmin(abs(f-lim[0])), np.argmin(abs(f-lim[1]))) # indices of the limits
         # ratios between the first and second singular value 
-        diffS1S2 = S_val[0,0,idxlim[0]:idxlim[1]]/S_val[1,1,idxlim[0]:idxlim[1]]
+        diffS1S2 = S_val[0,idxlim[0]:idxlim[1]]/S_val[1,idxlim[0]:idxlim[1]]
         maxDiffS1S2 = np.max(diffS1S2) # looking for the maximum difference
         idx1 = np.argmin(abs(diffS1S2 - maxDiffS1S2)) # index of the max diff
         idxfin = idxlim[0] + idx1 # final index
@@ -1134,7 +2350,7 @@ def EFDDmodEX(FreQ, Results, ndf=5, cm=1 , MAClim=0.85, sppk=3, npmax=30,
         Array containing the frequencies, identified from the singular values
         plot, which we want to extract.
     Results : dictionary
-        Dictionary of results obtained from FDDsvp().
+        Dictionary of results obtained from FDDsv() (or FDDsvp()).
     ndf : float
         Number of spectral lines in the proximity of FreQ[i] where the peak
         is searched.
@@ -1164,7 +2380,6 @@ def EFDDmodEX(FreQ, Results, ndf=5, cm=1 , MAClim=0.85, sppk=3, npmax=30,
         Dictionary of results ...
     '''
 
-    data = Results['Data']['Data']
     fs = Results['Data']['Samp. Freq.']
     df = Results['Data']['Freq. Resol.']
     S_val = Results['Singular Values']
@@ -1175,100 +2390,136 @@ def EFDDmodEX(FreQ, Results, ndf=5, cm=1 , MAClim=0.85, sppk=3, npmax=30,
     Res = FDDmodEX(FreQ, Results, ndf=ndf)
     Freq, Fi, index = Res['Frequencies'], Res['Mode Shapes'], Res['Freq. index']
     
-    nch=data.shape[1] # Number of channels
     freq_max = fs/2 # Nyquist frequency
     tlag = 1/df # time lag
     Nf = freq_max/df+1 # number of spectral lines
     f = np.linspace(0, int(freq_max), int(Nf)) # all spectral lines
     
-    nIFFT = (int(Nf))*20 # number of points for the inverse transform (zeropadding)
-    
     # Initialize Results
     Freq_E = []
     Fi_E = []
     Damp_E = []
     Figs = []
     
+    SDOFbells = np.zeros((len(Freq), int(Nf)), dtype=complex) # SDOF bells of all the modes
     
     for n in range(len(Freq)): # looping through all frequencies to estimate
         _fi = Fi[: , n] # Select reference mode shape (from FDD)
-        # Initialise SDOF bell and Mode Shape
-        SDOFbell = np.zeros(int(Nf), dtype=complex) # 
-        SDOFms = np.zeros((int(Nf), nch), dtype=complex)
+        # Initialise SDOF bell
+        SDOFbell = SDOFbells[n] # 
+        if method == "FSDD": 
+            # Enhanced PSD matrix (quadratic form with the reference shape)
+            _qform = _PSD_qform(PSD_matr, _fi)[:int(Nf)]
     
         for csm in range(cm):# Loop throug close mode (if any, default 1)
+            _svec = S_vec[csm, :, :int(Nf)].T # singular vectors (N°freq. lines x N°ch)
+            # MAC between the reference shape and the singular vectors, for
+            # all the frequency lines at once
+            _mask = MaC_batch(_fi[None, :], _svec)[0] > MAClim
             # Frequency Spatial Domain Decomposition variation (defaulf)
             if method == "FSDD": 
                 # Save values that satisfy MAC > MAClim condition
-                SDOFbell += np.array([_fi.conj().T@PSD_matr[:,:, _l]@_fi # Enhanced PSD matrix (frequency filtered)
-                                    if MaC(_fi, S_vec[csm,:,_l]) > MAClim 
-                                    else 0 
-                                    for _l in range(int(Nf))])
-                # Do the same for mode shapes
-                SDOFms += np.array([ S_vec[csm,:,_l]
-                                    if MaC(_fi, S_vec[csm,:,_l]) > MAClim 
-                                    else np.zeros(len(Freq)) 
-                                    for _l in range(int(Nf))]) 
+                SDOFbell += np.where(_mask, _qform, 0) # Enhanced PSD matrix (frequency filtered)
             # Classical Enhanced Frequency Domain Decomposition method
             else:
-                SDOFbell += np.array([S_val[csm, csm, _l]
-                                    if MaC(_fi, S_vec[csm,:,_l]) > MAClim 
-                                    else 0 
-                                    for _l in range(int(Nf) )])
-                SDOFms += np.array([ S_vec[csm,:,_l]
-                                    if MaC(_fi, S_vec[csm,:,_l]) > MAClim 
-                                    else np.zeros(len(Freq)) 
-                                    for _l in range(int(Nf))])             
-    
+                SDOFbell += np.where(_mask, S_val[csm, :int(Nf)], 0)
+    
+    # Time lags of the auto-correlation functions: a power of two time step 
+    # giving ppp to 2*ppp points per (damped) period of the mode, up to the 
+    # sppk+npmax peacks used in the fit plus a couple of periods margin 
+    # (within the first half of the time window)
+    ppp = 16
+    nlag = int(np.ceil(2*ppp*((sppk + npmax)/2 + 2))) + 1
+    # (non zero) lines of the bells, and chirp z-transforms of the lines, 
+    # one for each time step
+    _nz = np.flatnonzero(SDOFbells.any(axis=0))
+    _k0, _k1 = (_nz[0], _nz[-1]) if len(_nz) else (0, 0)
+    _czt = {}
+    
+    for n in range(len(Freq)):
+        SDOFbell = SDOFbells[n]
+        
         # indices of the singular values in SDOFsval       
         idSV = np.array(np.where(SDOFbell)).T
         fsval = f[idSV]
     
-        # Autocorrelation function (Free Decay)
-        SDOFcorr1 = np.fft.ifft(SDOFbell,n=nIFFT,axis=0,norm='ortho').real 
-        timeLag = np.linspace(0,tlag,len(SDOFcorr1)) # t
+        # Autocorrelation function (Free Decay), i.e. the real part of the 
+        # inverse Fourier transform of the SDOF bell, evaluated only at the 
+        # time lags needed
+        if Freq[n]*ppp*tlag > 2*(nlag - 1):
+            dt = 2.**np.floor(np.log2(1/(Freq[n]*ppp)))
+        else: # low frequency mode, use the whole first half of the window
+            dt = 2.**np.floor(np.log2(tlag/(2*(nlag - 1))))
+        if dt not in _czt:
+            _czt[dt] = signal.CZT(_k1 - _k0 + 1, m=nlag, w=np.exp(2j*np.pi*df*dt))
+        timeLag = np.arange(nlag)*dt # t
+        SDOFcorr1 = (_czt[dt](SDOFbell[_k0:_k1+1])
+                     *np.exp(2j*np.pi*df*_k0*timeLag)).real
     
         # NORMALISED AUTOCORRELATION
         idxmax = np.argmax(SDOFcorr1)
-        normSDOFcorr = SDOFcorr1[:len(SDOFcorr1)//2]/SDOFcorr1[idxmax]
+        normSDOFcorr = SDOFcorr1/SDOFcorr1[idxmax]
        
         # finding where x = 0
         sgn = np.sign(normSDOFcorr).real # finding the sign
         sgn1 = np.diff(sgn,axis=0) # finding where the sign changes (intersept with x=0)
         zc1 = np.where(sgn1)[0] # Zero crossing indices
     
-        # finding maximums and minimums (peacks) of the autoccorelation
-        maxSDOFcorr = [np.max(normSDOFcorr[zc1[_i]:zc1[_i+2]]) for _i in range(0,len(zc1)-2,2)]
-        minSDOFcorr = [np.min(normSDOFcorr[zc1[_i]:zc1[_i+2]]) for _i in range(0,len(zc1)-2,2)]
-        if len(maxSDOFcorr) > len(minSDOFcorr):
-            maxSDOFcorr = maxSDOFcorr[:-1]
-        elif len(maxSDOFcorr) < len(minSDOFcorr):
-            minSDOFcorr = minSDOFcorr[:-1]
-        minmax = np.array((minSDOFcorr, maxSDOFcorr))
-        minmax = np.ravel(minmax, order='F')
+        # finding maximums and minimums (peacks) of the autoccorelation, one 
+        # for each (contiguous) segment between every other zero crossing 
+        # (no peacks if there is not at least one complete segment)
+        if len(zc1) < 3:
+            minmax = np.zeros(0)
+            minmax_idx = np.zeros(0, dtype=int)
+        else:
+            _st = zc1[:-2:2] # start of the segments
+            _ln = np.diff(zc1[::2]) # length of the segments
+            _seg = normSDOFcorr[_st[0]:zc1[len(_st)*2]]
+            maxSDOFcorr = np.maximum.reduceat(_seg, _st - _st[0])
+            minSDOFcorr = np.minimum.reduceat(_seg, _st - _st[0])
+            minmax = np.ravel(np.array((minSDOFcorr, maxSDOFcorr)), order='F')
+        
+            # finding the indices of the peacks (first occurrence in the segment)
+            _segid = np.repeat(np.arange(len(_st)), _ln)
+            _hit = np.flatnonzero(_seg == maxSDOFcorr[_segid])
+            maxSDOFcorr_idx = _hit[np.unique(_segid[_hit], return_index=True)[1]] + _st[0]
+            _hit = np.flatnonzero(_seg == minSDOFcorr[_segid])
+            minSDOFcorr_idx = _hit[np.unique(_segid[_hit], return_index=True)[1]] + _st[0]
+            minmax_idx = np.ravel(np.array((minSDOFcorr_idx, maxSDOFcorr_idx)), order='F')
         
-        # finding the indices of the peacks
-        maxSDOFcorr_idx = [np.argmin(abs(normSDOFcorr-maxx)) for maxx in maxSDOFcorr]
-        minSDOFcorr_idx = [np.argmin(abs(normSDOFcorr-minn)) for minn in minSDOFcorr]
-        minmax_idx = np.array((minSDOFcorr_idx, maxSDOFcorr_idx))
-        minmax_idx = np.ravel(minmax_idx, order='F')
+        # refining the position and value of the peacks with a parabola 
+        # through the peack and its two neighbours (the lag grid is coarse)
+        _ym, _y0, _yp = (normSDOFcorr[minmax_idx + _i] for _i in (-1, 0, 1))
+        _den = _ym - 2*_y0 + _yp
+        _off = 0.5*np.divide(_ym - _yp, _den, out=np.zeros_like(_den), where=_den != 0)
+        minmax = _y0 - 0.25*(_ym - _yp)*_off
         
-        # Peacks and indices of the peacks to be used in the fitting
-        minmax_fit = np.array([minmax[_a] for _a in range(sppk,sppk+npmax)])
-        minmax_fit_idx = np.array([minmax_idx[_a] for _a in range(sppk,sppk+npmax)])
+        # Peacks, indices and times of the peacks to be used in the fitting
+        minmax_fit = minmax[sppk:sppk+npmax]
+        minmax_fit_idx = minmax_idx[sppk:sppk+npmax]
+        minmax_fit_t = (minmax_fit_idx + _off[sppk:sppk+npmax])*dt
+        if len(minmax_fit) < 2:
+            raise ValueError("Mode at {0:.3f} Hz: only {1} extrema of the "
+                             "auto-correlation function after the first sppk={2}, "
+                             "at least 2 are needed for the fit (reduce sppk or use "
+                             "a finer frequency resolution df)".format(Freq[n], len(minmax_fit), sppk))
+        elif len(minmax_fit) < npmax:
+            warnings.warn("Mode at {0:.3f} Hz: only {1} extrema of the "
+                          "auto-correlation function available for the fit "
+                          "(npmax={2})".format(Freq[n], len(minmax_fit), npmax))
         
         # estimating the natural frequency from the distance between the peaks
-        Td = np.diff(timeLag[minmax_fit_idx])*2 # *2 because we use both max and min
+        Td = np.diff(minmax_fit_t)*2 # *2 because we use both max and min
         Td_EFDD = np.mean(Td)
         
         fd_EFDD = 1/Td_EFDD # damped natural frequency
         
         # Log decrement 
-        delta = np.array([2*np.log(np.abs(minmax[0])/np.abs(minmax[_i])) for _i in range(len(minmax_fit))])
+        delta = 2*np.log(np.abs(minmax[0])/np.abs(minmax[:len(minmax_fit)]))
             
-        # Fit
-        _fit = lambda x,m:m*x
-        m, _ = curve_fit(_fit, np.arange(len(minmax_fit)), delta)
+        # Fit (least squares line through the origin, closed form)
+        _k = np.arange(len(minmax_fit))
+        m = (_k @ delta)/(_k @ _k)
         
         # damping ratio
         xi_EFDD = m/np.sqrt(4*np.pi**2 + m**2)
@@ -1289,9 +2540,10 @@ def EFDDmodEX(FreQ, Results, ndf=5, cm=1 , MAClim=0.85, sppk=3, npmax=30,
         # axes coordinates are 0,0 is bottom left and 1,1 is upper right
     
         if plot:
+            import matplotlib.pyplot as plt
             # PLOT 1 - Plotting the SDOF bell function extracted
             _fig, ((_ax1,_ax2),(_ax3,_ax4)) = plt.subplots(nrows=2,ncols=2)
-            _ax1.plot(f, 10*np.log10(S_val[0,0]), c='b')
+            _ax1.plot(f, 10*np.log10(S_val[0]), c='b')
             _ax1.plot(fsval, 10*np.log10(SDOFbell[idSV].real), c='r',label='SDOF bell')
             _ax1.set_title("SDOF Bell function")
             _ax1.set_xlabel('Frequency [Hz]')
@@ -1299,7 +2551,7 @@ def EFDDmodEX(FreQ, Results, ndf=5, cm=1 , MAClim=0.85, sppk=3, npmax=30,
             _ax1.legend()
             
             # Plot 2
-            _ax2.plot(timeLag[:len(SDOFcorr1)//2], normSDOFcorr)
+            _ax2.plot(timeLag, normSDOFcorr)
             _ax2.set_title("Auto-correlation Function")
             _ax2.set_xlabel('Time lag[s]')
             _ax2.set_ylabel('Normalized correlation') 